@@ -0,0 +1,484 @@
+"""
+Headless JSON API of the offset calculations shown in the dashboard.
+
+Serves the compensation days per method and the emission statistics of the catalog
+from the same loaders and calculation functions as streamlit_app.py, but runs
+independently of the Streamlit process:
+
+    python api_service.py --port 8000 --processes 4
+
+Endpoints:
+    GET  /health
+    GET  /products/<id>/compensation    compensation days of one product
+    POST /products/compensation         {"product_ids": [...]}, compensation days of many products
+    POST /emissions/compensation        {"emissions": [...]}, compensation days of any emissions in Kg/CO₂
+    GET  /products/<id>/stats           statistics of the category of a product and its percentile rank
+    GET  /categories/<name>/stats       statistics of one category (?level=detailed_category for subcategories)
+    POST /categories/stats              {"categories": [...], "level": "category"}, statistics of many categories
+
+Responses are cached per request and data version, HTTP connections are kept alive
+and the database connections are pooled. The data is synced in the background and right
+away on change notifications of the database (CO2_CHANGE_NOTIFICATIONS=1, see README.md).
+"""
+import os
+import json
+import logging
+import argparse
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+import numpy as np
+import pandas as pd
+import psycopg2
+import toml
+import tornado.web
+import tornado.ioloop
+import tornado.netutil
+import tornado.process
+import tornado.httpserver
+from utils.db_functions import ConnectionPool, ProductDataSync, load_live_tables
+from utils.snapshot_functions import SnapshotStore
+from utils.notify_functions import TableChangeListener, WATCHED_TABLES
+from utils.stats_functions import EmissionStats, build_stats_index, calc_percentile_rank
+from utils.calc_co2_offset_functions import calc_compensation_days_matrix
+from utils.metrics_functions import metrics, stage_timer
+
+logger = logging.getLogger(__name__)
+
+# Same data sources as the dashboard, see README.md
+OFFLINE_MODE = os.environ.get("CO2_OFFLINE_MODE", "0") == "1"
+SNAPSHOT_DIR = os.environ.get("CO2_SNAPSHOT_DIR", "snapshots")
+SECRETS_FILE = os.environ.get("CO2_SECRETS_FILE", ".streamlit/secrets.toml")
+CHANGE_NOTIFICATIONS = os.environ.get("CO2_CHANGE_NOTIFICATIONS", "0") == "1"
+
+REFRESH_INTERVAL = 300
+NOTIFIED_REFRESH_INTERVAL = 3600
+RESPONSE_CACHE_SIZE = 10_000
+# Bound of the request keys and responses held in the response cache
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESPONSE_MAX_AGE = 60
+MAX_BATCH_SIZE = 10_000
+
+STATS_LEVELS = ('category', 'detailed_category')
+
+
+class ServiceState(NamedTuple):
+    """
+    Data the responses are computed from, replaced as a whole on every change.
+    key identifies the data version and is part of every response cache key.
+    """
+    key: Tuple
+    products: pd.DataFrame
+    stats_index: Dict[str, Any]
+    compensation_matrix: pd.DataFrame
+    sun_hours: float
+    water_flow: float
+
+
+class OffsetService:
+    """
+    Keeps the product data and live tables up to date and derives the
+    statistics and compensation matrix once per data version.
+    """
+
+    def __init__(self, snapshot_store: SnapshotStore, pool: Optional[ConnectionPool] = None):
+        self.snapshot_store = snapshot_store
+        self.pool = pool
+        self.product_data_sync = ProductDataSync()
+        self.state: Optional[ServiceState] = None
+        self.response_cache: OrderedDict = OrderedDict()
+        self.response_cache_bytes = 0
+
+    def refresh(self, force: bool = False):
+        """
+        Syncs the data and rebuilds the state if the product data or the weather changed.
+        The product data is synced at most every min_interval seconds unless force is set.
+        Runs outside of the event loop, handlers keep using the previous state meanwhile.
+        """
+        with stage_timer("api_refresh"):
+            if self.product_data_sync.frame is None:
+                snapshot = self.snapshot_store.get('product_data')
+                if snapshot is not None:
+                    self.product_data_sync.seed(snapshot)
+
+            if self.pool is not None:
+                self.product_data_sync.refresh(self.pool, force=force)
+
+            live_tables = self._get_live_tables(['sun_hours', 'current_hydro_data'])
+            sun_hours = live_tables['sun_hours']
+            hydro_data_df = live_tables['current_hydro_data']
+
+            sun_hours_today = round(sun_hours['sum'].iloc[0] / 60, 2)
+            current_water_flow = float(hydro_data_df['aare_flow'].iloc[0])
+            key = (self.product_data_sync.version, sun_hours_today, current_water_flow)
+
+            if self.state is not None and self.state.key == key:
+                return
+
+            # The shared frame is read-only and replaced, never modified, by the sync
+            products, _ = self.product_data_sync.shared()
+            if products is None:
+                raise RuntimeError("No product data available")
+
+            self.state = ServiceState(key=key,
+                                      products=products,
+                                      stats_index=build_stats_index(products, STATS_LEVELS),
+                                      compensation_matrix=calc_compensation_days_matrix(
+                                          products['emission'], sun_hours_today, current_water_flow),
+                                      sun_hours=sun_hours_today,
+                                      water_flow=current_water_flow)
+            metrics.increment("api_state_rebuilds")
+
+    def cached_response(self, request_key: Tuple, build) -> bytes:
+        """
+        Returns the serialized response of request_key for the current state, built on a miss.
+
+        The cache holds at most RESPONSE_CACHE_SIZE responses and RESPONSE_CACHE_MAX_BYTES,
+        least recently used responses are evicted first. Responses bigger than a tenth of
+        the bytes (e.g. large batches) are not cached.
+        """
+        # The state may be replaced by a refresh meanwhile, so it is read once
+        state = self.state
+        key = (state.key, request_key)
+        response = self.response_cache.get(key)
+
+        if response is not None:
+            self.response_cache.move_to_end(key)
+            return response
+
+        metrics.increment("api_cache_misses")
+        response = json.dumps(build(state), allow_nan=False).encode()
+
+        size = _cache_entry_size(request_key, response)
+        if size <= RESPONSE_CACHE_MAX_BYTES // 10:
+            self.response_cache[key] = response
+            self.response_cache_bytes += size
+            while len(self.response_cache) > RESPONSE_CACHE_SIZE or \
+                    self.response_cache_bytes > RESPONSE_CACHE_MAX_BYTES:
+                (_, evicted_request_key), evicted = self.response_cache.popitem(last=False)
+                self.response_cache_bytes -= _cache_entry_size(evicted_request_key, evicted)
+
+        metrics.set_gauge("api_response_cache_bytes", self.response_cache_bytes)
+
+        return response
+
+    def _get_live_tables(self, tables: List[str]) -> Dict[str, pd.DataFrame]:
+        if self.pool is None:
+            frames = {table: self.snapshot_store.get(table) for table in tables}
+            missing = [table for table, df in frames.items() if df is None]
+            if missing:
+                raise RuntimeError(f"No local snapshot of {', '.join(missing)} available in offline mode")
+            return frames
+
+        frames = load_live_tables(self.pool, tables)
+        for table, df in frames.items():
+            self.snapshot_store.put(table, df)
+        return frames
+
+
+def _cache_entry_size(request_key: Tuple, response: bytes) -> int:
+    # Request keys of POST requests hold the request body
+    return len(response) + sum(len(part) for part in request_key if isinstance(part, (bytes, str)))
+
+
+def to_json_number(value: float) -> Optional[float]:
+    """
+    Converts numpy numbers to float, non-finite numbers (no offset possible) to None.
+    """
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+def compensation_records(days: pd.DataFrame) -> List[Dict[str, Optional[float]]]:
+    values = np.where(np.isfinite(days.to_numpy()), days.to_numpy(), np.nan)
+    return [{method: (None if np.isnan(value) else float(value)) for method, value in zip(days.columns, row)}
+            for row in values]
+
+
+def stats_record(stats: EmissionStats) -> Dict[str, Any]:
+    return {'count': stats.count,
+            'mean': to_json_number(stats.mean),
+            'min': to_json_number(stats.min),
+            'max': to_json_number(stats.max)}
+
+
+def parse_product_id(state: ServiceState, product_id: Any):
+    """
+    Converts a product ID from a path or body to the type of the product index.
+    """
+    if pd.api.types.is_integer_dtype(state.products.index):
+        return int(product_id)
+    return str(product_id)
+
+
+class BaseHandler(tornado.web.RequestHandler):
+
+    def initialize(self, service: OffsetService):
+        self.service = service
+
+    def prepare(self):
+        metrics.increment("api_requests", handler=type(self).__name__)
+        if self.service.state is None:
+            raise tornado.web.HTTPError(503, reason="Data not loaded yet")
+
+    def write_error(self, status_code: int, **kwargs):
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps({'error': self._reason}))
+
+    def write_json(self, response: bytes, cacheable: bool = True):
+        self.set_header("Content-Type", "application/json")
+        if cacheable:
+            self.set_header("Cache-Control", f"max-age={RESPONSE_MAX_AGE}")
+        self.finish(response)
+
+    def json_body(self) -> Dict[str, Any]:
+        try:
+            body = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="Invalid JSON body")
+        if not isinstance(body, dict):
+            raise tornado.web.HTTPError(400, reason="JSON body has to be an object")
+        return body
+
+    def list_field(self, body: Dict[str, Any], field: str, item_types: Tuple[type, ...]) -> List:
+        values = body.get(field)
+        if not isinstance(values, list):
+            raise tornado.web.HTTPError(400, reason=f"{field} has to be a list")
+        if len(values) > MAX_BATCH_SIZE:
+            raise tornado.web.HTTPError(413, reason=f"At most {MAX_BATCH_SIZE} {field} per request")
+        if not all(isinstance(value, item_types) and not isinstance(value, bool) for value in values):
+            names = ' or '.join(item_type.__name__ for item_type in item_types)
+            raise tornado.web.HTTPError(400, reason=f"{field} have to be of type {names}")
+        return values
+
+    def stats_level(self, level: str) -> str:
+        if level not in STATS_LEVELS:
+            raise tornado.web.HTTPError(400, reason=f"level has to be one of {', '.join(STATS_LEVELS)}")
+        return level
+
+
+class HealthHandler(BaseHandler):
+
+    def get(self):
+        state = self.service.state
+        self.write_json(json.dumps({'status': 'ok',
+                                    'product_data_version': state.key[0],
+                                    'products': len(state.products),
+                                    'sun_hours': state.sun_hours,
+                                    'water_flow': state.water_flow}).encode(), cacheable=False)
+
+
+class ProductCompensationHandler(BaseHandler):
+
+    def get(self, product_id: str):
+        def build(state: ServiceState):
+            try:
+                key = parse_product_id(state, product_id)
+                product = state.products.loc[key]
+            except (KeyError, ValueError):
+                return None
+
+            return {'product_id': product_id,
+                    'name': product['name'],
+                    'emission': to_json_number(product['emission']),
+                    'days': compensation_records(state.compensation_matrix.loc[[key]])[0],
+                    'sun_hours': state.sun_hours,
+                    'water_flow': state.water_flow}
+
+        response = self.service.cached_response(('product_compensation', product_id), build)
+        if response == b'null':
+            raise tornado.web.HTTPError(404, reason=f"Unknown product {product_id}")
+
+        self.write_json(response)
+
+
+class BatchProductCompensationHandler(BaseHandler):
+
+    def post(self):
+        product_ids = self.list_field(self.json_body(), 'product_ids', (int, str))
+
+        def build(state: ServiceState):
+            try:
+                keys = [parse_product_id(state, product_id) for product_id in product_ids]
+            except ValueError:
+                raise tornado.web.HTTPError(400, reason="Invalid product ID")
+
+            # Unknown products are reported instead of failing the whole batch
+            found = state.compensation_matrix.index.get_indexer(keys) >= 0
+            found_keys = [key for key, is_found in zip(keys, found) if is_found]
+            days = compensation_records(state.compensation_matrix.loc[found_keys])
+            emissions = state.products.loc[found_keys, 'emission'].to_numpy(dtype=float)
+
+            return {'results': [{'product_id': product_id, 'emission': float(emission), 'days': product_days}
+                                for product_id, emission, product_days
+                                in zip(np.asarray(product_ids, dtype=object)[found], emissions, days)],
+                    'missing': [product_id for product_id, is_found in zip(product_ids, found) if not is_found],
+                    'sun_hours': state.sun_hours,
+                    'water_flow': state.water_flow}
+
+        self.write_json(self.service.cached_response(('batch_compensation', self.request.body), build))
+
+
+class EmissionCompensationHandler(BaseHandler):
+
+    def post(self):
+        emissions = self.list_field(self.json_body(), 'emissions', (int, float))
+        try:
+            emissions = np.asarray(emissions, dtype=np.float64)
+        except (OverflowError, TypeError, ValueError):
+            raise tornado.web.HTTPError(400, reason="emissions have to be numbers")
+        # JSON bodies may hold NaN and Infinity, they would turn into NaN or negative days
+        if not (np.isfinite(emissions) & (emissions >= 0)).all():
+            raise tornado.web.HTTPError(400, reason="emissions have to be finite and not negative")
+
+        def build(state: ServiceState):
+            days = calc_compensation_days_matrix(emissions, state.sun_hours, state.water_flow)
+
+            return {'days': compensation_records(days),
+                    'sun_hours': state.sun_hours,
+                    'water_flow': state.water_flow}
+
+        self.write_json(self.service.cached_response(('emission_compensation', self.request.body), build))
+
+
+class ProductStatsHandler(BaseHandler):
+
+    def get(self, product_id: str):
+        level = self.stats_level(self.get_argument('level', 'category'))
+
+        def build(state: ServiceState):
+            try:
+                product = state.products.loc[parse_product_id(state, product_id)]
+            except (KeyError, ValueError):
+                return None
+
+            stats = state.stats_index[level][product[level]]
+            return {'product_id': product_id,
+                    'emission': to_json_number(product['emission']),
+                    level: product[level],
+                    'stats': stats_record(stats),
+                    'percentile_rank': calc_percentile_rank(stats, product['emission'])}
+
+        response = self.service.cached_response(('product_stats', product_id, level), build)
+        if response == b'null':
+            raise tornado.web.HTTPError(404, reason=f"Unknown product {product_id}")
+
+        self.write_json(response)
+
+
+class CategoryStatsHandler(BaseHandler):
+
+    def get(self, category: str):
+        level = self.stats_level(self.get_argument('level', 'category'))
+
+        def build(state: ServiceState):
+            stats = state.stats_index[level].get(category)
+            return None if stats is None else {level: category, 'stats': stats_record(stats)}
+
+        response = self.service.cached_response(('category_stats', category, level), build)
+        if response == b'null':
+            raise tornado.web.HTTPError(404, reason=f"Unknown {level} {category}")
+
+        self.write_json(response)
+
+
+class BatchCategoryStatsHandler(BaseHandler):
+
+    def post(self):
+        body = self.json_body()
+        categories = self.list_field(body, 'categories', (str,))
+        level = self.stats_level(body.get('level', 'category'))
+
+        def build(state: ServiceState):
+            level_stats = state.stats_index[level]
+            return {'results': [{level: category, 'stats': stats_record(level_stats[category])}
+                                for category in categories if category in level_stats],
+                    'missing': [category for category in categories if category not in level_stats]}
+
+        self.write_json(self.service.cached_response(('batch_category_stats', self.request.body), build))
+
+
+def make_app(service: OffsetService) -> tornado.web.Application:
+    handlers = [
+        (r"/health", HealthHandler),
+        (r"/products/compensation", BatchProductCompensationHandler),
+        (r"/products/([^/]+)/compensation", ProductCompensationHandler),
+        (r"/emissions/compensation", EmissionCompensationHandler),
+        (r"/products/([^/]+)/stats", ProductStatsHandler),
+        (r"/categories/stats", BatchCategoryStatsHandler),
+        (r"/categories/([^/]+)/stats", CategoryStatsHandler),
+    ]
+
+    return tornado.web.Application([(pattern, handler, {'service': service}) for pattern, handler in handlers],
+                                   compress_response=True)
+
+
+def create_connection_pool() -> Optional[ConnectionPool]:
+    """
+    Pool of connections to the database of the dashboard (same secrets), None in offline mode.
+    """
+    if OFFLINE_MODE:
+        return None
+
+    postgres_secrets = toml.load(SECRETS_FILE)['postgres']
+    return ConnectionPool(lambda: psycopg2.connect(**postgres_secrets), max_size=4)
+
+
+def start_change_listener(service: OffsetService) -> TableChangeListener:
+    """
+    Refreshes the service as soon as the database notifies a change of a watched table.
+    """
+    io_loop = tornado.ioloop.IOLoop.current()
+    postgres_secrets = toml.load(SECRETS_FILE)['postgres']
+
+    def on_change(force: bool):
+        # Called from the listener thread
+        io_loop.add_callback(lambda: io_loop.spawn_callback(refresh_service, service, force))
+
+    listener = TableChangeListener(lambda: psycopg2.connect(**postgres_secrets),
+                                   {table: (lambda table=table: on_change(table == 'product_data'))
+                                    for table in WATCHED_TABLES},
+                                   on_connect=lambda: on_change(True))
+    listener.start()
+
+    return listener
+
+
+async def refresh_service(service: OffsetService, force: bool = False):
+    try:
+        await tornado.ioloop.IOLoop.current().run_in_executor(None, service.refresh, force)
+    except Exception:
+        logger.warning("Refresh of the API data failed", exc_info=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--address', default='')
+    parser.add_argument('--processes', type=int, default=1,
+                        help="Number of server processes sharing the port, 0 for one per CPU")
+    args = parser.parse_args()
+
+    sockets = tornado.netutil.bind_sockets(args.port, address=args.address)
+    if args.processes != 1:
+        tornado.process.fork_processes(args.processes)
+
+    # Every process loads its own data after forking
+    service = OffsetService(SnapshotStore(SNAPSHOT_DIR), create_connection_pool())
+    service.refresh()
+
+    server = tornado.httpserver.HTTPServer(make_app(service), xheaders=True)
+    server.add_sockets(sockets)
+
+    # With change notifications the periodic refresh only catches up on missed changes
+    refresh_interval = REFRESH_INTERVAL
+    if CHANGE_NOTIFICATIONS and service.pool is not None:
+        start_change_listener(service)
+        refresh_interval = NOTIFIED_REFRESH_INTERVAL
+
+    tornado.ioloop.PeriodicCallback(lambda: tornado.ioloop.IOLoop.current().spawn_callback(refresh_service, service),
+                                    refresh_interval * 1000).start()
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""
+Headless benchmark of the rerun pipeline of streamlit_app.py on synthetic catalogs.
+
+Builds synthetic product_data, current_weather, sun_hours and current_hydro_data tables,
+loads them into a local SQLite stand-in database and times every stage of a rerun:
+load, query_selected_points, create_color_list, figure building and serialization.
+Every size runs in its own process so the reported peak memory belongs to that size.
+With --app-test the whole app is additionally run headlessly with Streamlit's
+LocalScriptRunner in offline mode from Parquet snapshots of the same tables.
+
+Results are appended as JSON lines to the output file.
+
+Usage:
+    python benchmarks/benchmark_pipeline.py --sizes 1000 10000 100000 1000000
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from queue import Empty
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from utils.db_functions import ConnectionPool, ProductDataSync, LIVE_TABLE_FALLBACKS, \
+    load_live_tables  # noqa: E402
+from utils.snapshot_functions import SnapshotStore  # noqa: E402
+from utils.stats_functions import build_stats_index, get_emission_window  # noqa: E402
+from utils.search_functions import ProductSearchIndex  # noqa: E402
+from utils.calc_co2_offset_functions import calc_compensation_days_matrix  # noqa: E402
+from utils.pipeline_functions import build_product_pipeline, query_selected_points  # noqa: E402
+from utils.plot_functions import create_color_list, create_color_legend, build_product_data_fig, \
+    build_product_density_fig, build_product_comparison_fig, choose_render_mode  # noqa: E402
+
+NUM_CATEGORIES = 12
+NUM_SUBCATEGORIES = 80
+
+
+def create_synthetic_tables(num_products: int, seed: int = 42) -> Dict[str, pd.DataFrame]:
+    """
+    Creates synthetic tables with the columns streamlit_app.py reads.
+    """
+    rng = np.random.default_rng(seed)
+
+    subcategory_codes = rng.integers(0, NUM_SUBCATEGORIES, num_products)
+    words = np.array(['Bio', 'Milch', 'Brot', 'Käse', 'Apfel', 'Tomaten', 'Premium', 'Budget',
+                      'Schokolade', 'Joghurt', 'Pasta', 'Reis', 'Kaffee', 'Tee', 'Saft', 'Butter'])
+    names = pd.Series(words[rng.integers(0, len(words), num_products)]) + " " + \
+        pd.Series(words[rng.integers(0, len(words), num_products)]) + " " + \
+        pd.Series(rng.integers(1, 1000, num_products)).astype(str)
+
+    product_data = pd.DataFrame({
+        'id': np.arange(1, num_products + 1),
+        'name': names,
+        'category': pd.Series(subcategory_codes % NUM_CATEGORIES).map(lambda c: f"Category {c}"),
+        'detailed_category': pd.Series(subcategory_codes).map(lambda c: f"Subcategory {c}"),
+        'price': np.round(rng.gamma(2, 4, num_products), 2) + 0.05,
+        'compensation_price': np.round(rng.gamma(1, 0.1, num_products), 2),
+        'emission': np.round(rng.gamma(1.5, 2, num_products), 3) + 0.001,
+        'weight_gram': rng.integers(10, 5000, num_products),
+        'updated_at': pd.Timestamp('2023-01-01').isoformat(),
+    })
+
+    # Three years of daily sun hours (in minutes) and Aare flow following the seasons
+    dates = pd.date_range('2020-01-01', '2022-12-31')
+    season = np.sin((dates.dayofyear.to_numpy() - 80) / 365 * 2 * np.pi)
+
+    return {
+        'product_data': product_data,
+        'current_weather': pd.DataFrame({'condition': ['sun'], 'TTT_C': [21.5]}),
+        'sun_hours': pd.DataFrame({'sum': [420.0]}),
+        'current_hydro_data': pd.DataFrame({'aare_temp': [17.2], 'aare_flow': [120.0]}),
+        'sun_hours_history': pd.DataFrame({'date': dates,
+                                           'sum': np.clip(360 + 240 * season + rng.normal(0, 120, len(dates)), 0, None)}),
+        'hydro_history': pd.DataFrame({'date': dates,
+                                       'aare_flow': np.clip(150 + 80 * season + rng.normal(0, 30, len(dates)), 20, None)}),
+    }
+
+
+@contextmanager
+def timed(timings: Dict[str, float], stage: str):
+    start = time.perf_counter()
+    yield
+    timings[stage] = round(time.perf_counter() - start, 6)
+
+
+def run_pipeline(num_products: int, work_dir: str) -> Dict[str, float]:
+    """
+    Runs the stages of one rerun of the app outside of Streamlit and returns their timings.
+    """
+    tables = create_synthetic_tables(num_products)
+    db_path = os.path.join(work_dir, f"product_data_{num_products}.db")
+
+    with sqlite3.connect(db_path) as conn:
+        for table, df in tables.items():
+            df.to_sql(table, conn, index=False, if_exists='replace')
+        for table, view in LIVE_TABLE_FALLBACKS.items():
+            conn.execute(f"DROP VIEW IF EXISTS {view};")
+            conn.execute(f"CREATE VIEW {view} AS SELECT * FROM {table};")
+
+    # Pooled connections are used by the threads of the live table loader
+    pool = ConnectionPool(lambda: sqlite3.connect(db_path, check_same_thread=False), max_size=3)
+    timings: Dict[str, float] = {}
+
+    with timed(timings, 'load_product_data'):
+        product_data_sync = ProductDataSync()
+        product_data_sync.refresh(pool)
+        product_data_df = product_data_sync.copy()
+
+    with timed(timings, 'load_live_data'):
+        live_tables = load_live_tables(pool, ['current_weather', 'sun_hours', 'current_hydro_data'])
+        sun_hours = live_tables['sun_hours']
+        hydro_data_df = live_tables['current_hydro_data']
+
+    with timed(timings, 'build_stats_index'):
+        stats_index = build_stats_index(product_data_df)
+
+    with timed(timings, 'build_search_index'):
+        search_index = ProductSearchIndex(product_data_df)
+
+    with timed(timings, 'compensation_matrix'):
+        compensation_matrix = calc_compensation_days_matrix(product_data_df['emission'],
+                                                            sun_hours['sum'].iloc[0] / 60,
+                                                            hydro_data_df['aare_flow'].iloc[0])
+
+    # Lookup of a chart selection of 1% of the products in the unfiltered catalog, as in the pipeline
+    selection = set(product_data_df.index[::100].tolist())
+    with timed(timings, 'query_selected_points'):
+        query_selected_points(product_data_df, np.arange(len(product_data_df)), frozenset(selection))
+
+    product_data_df['selected'] = product_data_df.index.isin(selection)
+
+    with timed(timings, 'create_color_list'):
+        color_list, color_legend_list = create_color_list(product_data_df, 'category')
+        create_color_legend(color_legend_list)
+
+    render_mode = choose_render_mode(len(product_data_df))
+    with timed(timings, 'build_product_data_fig'):
+        if render_mode == 'density':
+            product_fig = build_product_density_fig(product_data_df)
+        else:
+            product_fig = build_product_data_fig(product_data_df, color_list, mode=render_mode)
+
+    with timed(timings, 'serialize_product_data_fig'):
+        product_fig.to_json()
+
+    # Reruns of the dependency-tracked pipeline of the app including the serialization of the
+    # chart: cold, after a new chart selection (only the selection-dependent stages are recomputed
+    # and the selection is patched into the cached figure JSON) and without any change
+    pipeline = build_product_pipeline()
+    pipeline_targets = ['view_render_mode', 'product_fig', 'legend_html', 'picker_ids']
+    catalog_df, catalog_version = product_data_sync.shared()
+    pipeline_sources = {'catalog': catalog_df, 'categories': None, 'subcategories': None, 'zoom': None,
+                        'selection': frozenset(), 'color_level': 'category', 'filter_level': 'Category'}
+    pipeline_keys = {'catalog': catalog_version}
+
+    with timed(timings, 'pipeline_cold'):
+        pipeline.run(pipeline_targets, pipeline_sources, pipeline_keys)['product_fig'].to_json()
+
+    with timed(timings, 'pipeline_selection_change'):
+        pipeline.run(pipeline_targets, {**pipeline_sources, 'selection': frozenset(selection)},
+                     pipeline_keys)['product_fig'].to_json()
+
+    with timed(timings, 'pipeline_unchanged'):
+        pipeline.run(pipeline_targets, {**pipeline_sources, 'selection': frozenset(selection)},
+                     pipeline_keys)['product_fig'].to_json()
+
+    with timed(timings, 'search_product'):
+        product_ids, _ = search_index.search("bio milch")
+        product_id = product_ids[0] if len(product_ids) else product_data_df.index[0]
+
+    with timed(timings, 'build_product_comparison_fig'):
+        selected_product = product_data_df.loc[product_id]
+        cat_stats = stats_index['category'][selected_product['category']]
+        window_ids = get_emission_window(cat_stats.emissions, cat_stats.product_ids, product_id,
+                                         selected_product['emission'])
+        comparison_fig = build_product_comparison_fig(selected_product, product_data_df.loc[window_ids])
+        comparison_fig.to_json()
+        compensation_matrix.loc[product_id]
+
+    timings['render_mode'] = render_mode  # type: ignore
+    pool.close()
+
+    return timings
+
+
+def run_app_test(num_products: int, work_dir: str) -> Dict[str, float]:
+    """
+    Runs the whole app headlessly in offline mode with Streamlit's LocalScriptRunner,
+    once from a new session and once as rerun of that session.
+    """
+    from streamlit.runtime import Runtime, RuntimeConfig
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.testing.local_script_runner import LocalScriptRunner
+
+    snapshot_dir = os.path.join(work_dir, f"snapshots_{num_products}")
+    snapshot_store = SnapshotStore(snapshot_dir)
+    for table, df in create_synthetic_tables(num_products).items():
+        snapshot_store.put(table, df)
+
+    os.environ['CO2_OFFLINE_MODE'] = "1"
+    os.environ['CO2_SNAPSHOT_DIR'] = snapshot_dir
+
+    # The app opens its assets relative to the repository root
+    os.chdir(ROOT_DIR)
+    script_path = os.path.join(ROOT_DIR, 'streamlit_app.py')
+    if not Runtime.exists():
+        # The script runner takes the media files and caches from the runtime, it is not started
+        Runtime(RuntimeConfig(script_path, None, MemoryMediaFileStorage("/media"), MemoryCacheStorageManager()))
+
+    timings: Dict[str, float] = {}
+    session_state = None
+    for name in ('app_test_first_run', 'app_test_rerun'):
+        # A runner runs the script once, the rerun continues with the session state of the first run
+        runner = LocalScriptRunner(script_path, prev_session_state=session_state)
+        with timed(timings, name):
+            runner.run(timeout=600)
+        runner.join()
+        session_state = runner.session_state
+
+        exceptions = [msg.delta.new_element.exception.message for msg in runner.forward_msgs()
+                      if msg.HasField('delta') and msg.delta.new_element.HasField('exception')]
+        if exceptions:
+            timings['app_test_error'] = exceptions[0]  # type: ignore
+            break
+
+    return timings
+
+
+def benchmark_size(num_products: int, work_dir: str, app_test: bool, queue):
+    stages = run_pipeline(num_products, work_dir)
+    result = {'num_products': num_products, 'render_mode': stages.pop('render_mode'), 'stages': stages}
+
+    if app_test:
+        result['stages'].update(run_app_test(num_products, work_dir))
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_memory_mb'] = round(max_rss / (1024 ** 2 if sys.platform == 'darwin' else 1024), 1)
+
+    queue.put(result)
+
+
+def wait_for_result(process, queue, timeout: float) -> Optional[dict]:
+    """
+    Result of the benchmark process of one size, None if the process exited without
+    a result (e.g. killed for running out of memory). Processes that do not finish
+    within timeout are terminated.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if not process.is_alive():
+                # The result may have been put right before the process exited
+                try:
+                    return queue.get(timeout=1)
+                except Empty:
+                    return None
+
+    process.terminate()
+    return None
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                                       text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000, 1_000_000],
+                        help="Number of products of the synthetic catalogs")
+    parser.add_argument('--output', default=os.path.join(ROOT_DIR, 'benchmarks', 'results.jsonl'),
+                        help="JSON lines file the results are appended to")
+    parser.add_argument('--app-test', action='store_true',
+                        help="Also run the whole app headlessly with Streamlit's LocalScriptRunner")
+    parser.add_argument('--timeout', type=float, default=3600,
+                        help="Seconds a single catalog size may take before it is aborted")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    run_info = {'timestamp': pd.Timestamp.now(tz='UTC').isoformat(), 'commit': get_git_commit(),
+                'python': platform.python_version(), 'machine': platform.machine()}
+
+    with tempfile.TemporaryDirectory() as work_dir, open(args.output, 'a') as output:
+        for num_products in args.sizes:
+            queue = context.Queue()
+            process = context.Process(target=benchmark_size, args=(num_products, work_dir, args.app_test, queue))
+            process.start()
+            result = wait_for_result(process, queue, args.timeout)
+            process.join()
+
+            if result is None:
+                # A negative exit code is the signal the process was killed with, e.g. -9 by the OOM killer
+                result = {'num_products': num_products,
+                          'error': f"No result, the benchmark process exited with code {process.exitcode}"}
+
+            result = {**run_info, **result}
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Streaming batch calculation of compensation figures for large product files.
+
+Reads a CSV or Parquet file of products in chunks, calculates the compensation days
+per method with the models of utils/calc_co2_offset_functions.py and ranks every
+product within its category of the catalog, the same statistics the dashboard shows.
+Chunks are processed by a pool of worker processes and written to the output file
+in input order as soon as they are done, so memory stays bounded by the chunk size
+and the number of chunks in flight, independent of the file size.
+
+    python offset_batch.py suppliers.parquet offsets.parquet --workers 8
+
+The input needs an emission column (Kg/CO₂ per unit), quantity and the category
+column of --level are used if present. Unlike the basket of the dashboard, which
+drops products without quantity, products without quantity count once here, so
+every input row gets a result. The catalog statistics and the weather are
+read from the snapshots of the dashboard (CO2_SNAPSHOT_DIR), --sun-hours and
+--water-flow override the weather.
+"""
+import os
+import sys
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, Optional
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from utils.snapshot_functions import SnapshotStore
+from utils.stats_functions import EmissionStats, build_stats_index, calc_percentile_ranks
+from utils.calc_co2_offset_functions import calc_compensation_days_matrix, COMPENSATION_METHODS
+
+SNAPSHOT_DIR = os.environ.get("CO2_SNAPSHOT_DIR", "snapshots")
+
+CHUNK_SIZE = 100_000
+
+# Read with fixed dtypes, so all CSV chunks have the same schema in the output,
+# the other CSV columns are read as strings
+NUMERIC_COLUMNS = {'emission': 'float64', 'quantity': 'float64'}
+
+# Columns added to the input columns
+RESULT_COLUMNS = ['total_emission', *(f'days_{method}' for method in COMPENSATION_METHODS)]
+STATS_COLUMNS = ['category_mean_emission', 'delta_to_category_mean_pct', 'percentile_rank']
+
+# Set in every worker process by init_worker
+_worker_context: Dict[str, Any] = {}
+
+
+def read_input_schema(path: str) -> pa.Schema:
+    """
+    Schema of a CSV or Parquet file without reading its rows, CSV columns have the
+    types they are read with by read_chunks.
+    """
+    if path.endswith('.parquet'):
+        return pq.ParquetFile(path).schema_arrow
+
+    columns = pd.read_csv(path, nrows=0).columns
+    return pa.schema([(column, pa.float64() if column in NUMERIC_COLUMNS else pa.string())
+                      for column in columns])
+
+
+def build_output_schema(input_schema: pa.Schema, with_stats: bool) -> pa.Schema:
+    """
+    Schema of the output, the input columns followed by the calculated float columns.
+    Fixed up front, so chunks with e.g. only missing values in a column have the same schema.
+    """
+    fields = [field.remove_metadata() for field in input_schema if field.name not in RESULT_COLUMNS + STATS_COLUMNS]
+    calculated = RESULT_COLUMNS + (STATS_COLUMNS if with_stats else [])
+
+    return pa.schema(fields + [(column, pa.float64()) for column in calculated])
+
+
+def read_chunks(path: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """
+    Reads a CSV or Parquet file in chunks of chunk_size rows.
+    """
+    if path.endswith('.parquet'):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            # Stored pandas indexes stay columns, as in read_input_schema
+            yield batch.to_pandas(ignore_metadata=True)
+    else:
+        dtypes = {field.name: NUMERIC_COLUMNS.get(field.name, 'string') for field in read_input_schema(path)}
+        yield from pd.read_csv(path, chunksize=chunk_size, dtype=dtypes)
+
+
+class ChunkWriter:
+    """
+    Appends chunks to a CSV or Parquet file, every chunk is converted to the given Parquet schema.
+    """
+
+    def __init__(self, path: str, schema: pa.Schema):
+        self.path = path
+        self.schema = schema
+        self.rows = 0
+        self._parquet_writer: Optional[pq.ParquetWriter] = None
+
+    def write(self, df: pd.DataFrame):
+        if self.path.endswith('.parquet'):
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.path, self.schema)
+            self._parquet_writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+        else:
+            df.to_csv(self.path, mode='w' if self.rows == 0 else 'a', header=self.rows == 0, index=False)
+
+        self.rows += len(df)
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+
+def init_worker(category_stats: Optional[Dict[Any, EmissionStats]], level: str, sun_hours: float,
+                water_flow: float):
+    """
+    Receives the catalog statistics and weather once per worker instead of once per chunk.
+    """
+    _worker_context.update(category_stats=category_stats, level=level, sun_hours=sun_hours,
+                           water_flow=water_flow)
+
+
+def process_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds the emission, the compensation days per method and the category statistics to a chunk.
+    """
+    emissions = chunk['emission'].to_numpy(dtype=np.float64)
+    if 'quantity' in chunk.columns:
+        # Products without quantity count once (the basket of the dashboard drops them instead)
+        emissions = emissions * chunk['quantity'].fillna(1).to_numpy(dtype=np.float64)
+
+    days = calc_compensation_days_matrix(emissions, _worker_context['sun_hours'], _worker_context['water_flow'])
+
+    result = chunk.copy()
+    result['total_emission'] = emissions
+    for method in days.columns:
+        result[f'days_{method}'] = days[method].to_numpy()
+
+    level = _worker_context['level']
+    if _worker_context['category_stats'] is not None and level in chunk.columns:
+        # Products are ranked per unit like in the dashboard
+        ranks, means = calc_percentile_ranks(_worker_context['category_stats'], chunk[level],
+                                             chunk['emission'])
+        result['category_mean_emission'] = means
+        result['delta_to_category_mean_pct'] = (chunk['emission'].to_numpy(dtype=np.float64) / means - 1) * 100
+        result['percentile_rank'] = ranks
+
+    return result
+
+
+def load_context(args) -> Dict[str, Any]:
+    """
+    Loads the catalog statistics and the weather from the snapshots, overridden by args.
+    """
+    snapshot_store = SnapshotStore(SNAPSHOT_DIR)
+
+    sun_hours = args.sun_hours
+    if sun_hours is None:
+        sun_hours_df = snapshot_store.get('sun_hours')
+        if sun_hours_df is None:
+            sys.exit("No sun_hours snapshot available, pass --sun-hours")
+        sun_hours = round(sun_hours_df['sum'].iloc[0] / 60, 2)
+
+    water_flow = args.water_flow
+    if water_flow is None:
+        hydro_data_df = snapshot_store.get('current_hydro_data')
+        if hydro_data_df is None:
+            sys.exit("No current_hydro_data snapshot available, pass --water-flow")
+        water_flow = float(hydro_data_df['aare_flow'].iloc[0])
+
+    category_stats = None
+    product_data_df = snapshot_store.get('product_data')
+    if product_data_df is not None:
+        category_stats = build_stats_index(product_data_df, levels=(args.level,))[args.level]
+    else:
+        print("No product_data snapshot available, category statistics are skipped")
+
+    return {'category_stats': category_stats, 'level': args.level, 'sun_hours': sun_hours,
+            'water_flow': water_flow}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help="CSV or Parquet file of products")
+    parser.add_argument('output', help="CSV or Parquet file the results are written to")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--level', choices=['category', 'detailed_category'], default='category',
+                        help="Category level the products are ranked in")
+    parser.add_argument('--sun-hours', type=float, help="Sun hours per day")
+    parser.add_argument('--water-flow', type=float, help="Aare flow in m3/s")
+    args = parser.parse_args()
+
+    context = load_context(args)
+    input_schema = read_input_schema(args.input)
+    with_stats = context['category_stats'] is not None and args.level in input_schema.names
+    writer = ChunkWriter(args.output, build_output_schema(input_schema, with_stats))
+    max_in_flight = 2 * args.workers
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                             initargs=tuple(context.values())) as executor:
+        pending = deque()
+
+        # At most max_in_flight chunks are read ahead, results are written in input order
+        for chunk in read_chunks(args.input, args.chunk_size):
+            pending.append(executor.submit(process_chunk, chunk))
+            if len(pending) >= max_in_flight:
+                writer.write(pending.popleft().result())
+
+        while pending:
+            writer.write(pending.popleft().result())
+
+    writer.close()
+
+    duration = time.perf_counter() - start
+    print(f"{writer.rows} products written to {args.output} in {duration:.1f} s "
+          f"({writer.rows / max(duration, 1e-9):.0f} products/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,318 @@
+import os
+import math
+import logging
+import time
 import psycopg2
 import asyncio
 import streamlit as st
+import numpy as np
 import pandas as pd
-from typing import Dict, Set, List
-from PIL import Image
+from typing import Any, Dict, Set, List, Optional, Sequence, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from streamlit_plotly_events import plotly_events
-from utils.design_functions import style_columns, assign_weather_background
-from utils.helper_functions import read_markdown
-from utils.calc_co2_offset_functions import calc_solar_energy_offset, calc_trees_offset, calc_hydro_offset
-from utils.plot_functions import create_color_list, build_product_data_fig, build_product_comparison_fig, \
-    create_color_legend
+from utils.design_functions import style_columns, assign_weather_background, show_image
+from utils.asset_functions import AssetBundle
+from utils.metrics_functions import metrics, stage_timer, timed_stage, instrument_cache, RerunProfiler
+from utils.animation_functions import plan_animation_frames, calc_frame_percentages, format_days
+from utils.db_functions import ConnectionPool, ProductDataSync, load_live_tables
+from utils.snapshot_functions import SnapshotStore
+from utils.notify_functions import TableChangeListener, WATCHED_TABLES
+from utils.search_functions import ProductSearchIndex
+from utils.seasonal_functions import build_seasonal_profile, build_seasonal_offsets, \
+    calc_compensation_days_seasonal
+from utils.stats_functions import build_stats_index, calc_percentile_rank, get_emission_window
+from utils.calc_co2_offset_functions import calc_compensation_days_matrix, calc_basket_compensation, \
+    COMPENSATION_METHODS
+from utils.pipeline_functions import Pipeline, build_product_pipeline, build_colors, build_base_fig
+from utils.plot_functions import build_product_comparison_fig, build_basket_share_fig
+
+logger = logging.getLogger(__name__)
+
+# Times the whole rerun and captures sampled profiles of slow reruns
+rerun_profiler = RerunProfiler()
+
+
+def stop_rerun():
+    """
+    Stops the rerun like st.stop() and records it as aborted.
+    """
+    rerun_profiler.finish(aborted=True)
+    st.stop()
+
+
+def restart_rerun():
+    """
+    Reruns the script like st.experimental_rerun() and records the current rerun as aborted.
+    """
+    rerun_profiler.finish(aborted=True)
+    st.experimental_rerun()
+
 
 # --- Layout ----
 style_columns()
 
 
 # --- Data Query ---
-@st.cache_resource(ttl=3200)
-def init_connection():
-    return psycopg2.connect(**st.secrets["postgres"])
 
+# Serve all data from the local snapshots without any database
+OFFLINE_MODE = os.environ.get("CO2_OFFLINE_MODE", "0") == "1"
+SNAPSHOT_DIR = os.environ.get("CO2_SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_MAX_AGE = 3600
+
+# Refresh tables as soon as the database notifies a change (see README.md), snapshots of
+# notified tables are then only refreshed by age as a fallback after NOTIFIED_SNAPSHOT_MAX_AGE
+CHANGE_NOTIFICATIONS = os.environ.get("CO2_CHANGE_NOTIFICATIONS", "0") == "1"
+NOTIFIED_SNAPSHOT_MAX_AGE = 24 * 3600
+
+
+@st.cache_resource
+def init_connection_pool():
+    """
+    Bounded connection pool shared by all sessions. Dead connections are
+    replaced on checkout, so a dropped connection does not break the app.
+    """
+    return ConnectionPool(lambda: psycopg2.connect(**st.secrets["postgres"]), max_size=10)
+
+
+@st.cache_resource
+def init_snapshot_store():
+    """
+    Local Parquet snapshots of the tables shared by all sessions.
+    """
+    return SnapshotStore(SNAPSHOT_DIR)
+
+
+# Tables with the current weather, sun hours and Aare data
+LIVE_TABLES = ('current_weather', 'sun_hours', 'current_hydro_data')
+
+
+@timed_stage("get_data_from_db")
+def load_tables_from_db(tables: Sequence[str]) -> Dict[str, pd.DataFrame]:
+    """
+    Loads tables concurrently from the database and falls back to the last
+    available data if there is no current data anymore.
+    """
+    return load_live_tables(connection_pool, tables)
+
+
+def prefetch_tables(tables: Sequence[str], executor: ThreadPoolExecutor) -> Optional[Future]:
+    """
+    Starts loading the tables without a local snapshot from the database in executor,
+    so they load while e.g. the product data loads. None if there is nothing to load.
+    """
+    missing = [table for table in tables if snapshot_store.get(table) is None]
+    if OFFLINE_MODE or not missing:
+        return None
+
+    return executor.submit(load_tables_from_db, missing)
+
+
+def get_tables(tables: Sequence[str], required: bool = True,
+               prefetched: Optional[Future] = None) -> Dict[str, Optional[pd.DataFrame]]:
+    """
+    Serves tables from their local snapshots and refreshes outdated snapshots in the background.
+    Only blocks on the database for tables without a snapshot, these are loaded concurrently
+    or taken from prefetched (see prefetch_tables).
+    Tables that are not required are None in offline mode if there is no snapshot.
+    """
+    frames = {}
+    for table in tables:
+        frames[table] = snapshot_store.get(table)
+        metrics.set_gauge("snapshot_age_seconds", snapshot_store.age(table), table=table)
+
+    missing = [table for table in tables if frames[table] is None]
+
+    if OFFLINE_MODE:
+        if missing and required:
+            st.error(f"No local snapshot of {', '.join(missing)} available in offline mode.")
+            stop_rerun()
+        return frames
+
+    if missing:
+        loaded = prefetched.result() if prefetched is not None else load_tables_from_db(missing)
+        for table in missing:
+            frames[table] = loaded[table]
+            snapshot_store.put(table, loaded[table])
+
+    for table in tables:
+        if table not in missing and snapshot_store.age(table) > snapshot_max_age(table):
+            snapshot_store.refresh_async(table, lambda table=table: load_tables_from_db([table])[table])
+
+    return frames
+
+
+def snapshot_max_age(table: str) -> float:
+    """
+    Age after which the snapshot of table is refreshed, longer for tables whose changes are pushed.
+    """
+    if table in WATCHED_TABLES and change_listener is not None and change_listener.connected:
+        return NOTIFIED_SNAPSHOT_MAX_AGE
+    return SNAPSHOT_MAX_AGE
+
+
+def refresh_table(table: str):
+    """
+    Refreshes the snapshot of a changed table in the background. Changes of the
+    product data are synced, the other tables are reloaded.
+    """
+    if table == 'product_data':
+        snapshot_store.refresh_async(table, sync_product_data, queue=True)
+    else:
+        snapshot_store.refresh_async(table, lambda: load_tables_from_db([table])[table], queue=True)
+
+
+def sync_product_data() -> Optional[pd.DataFrame]:
+    """
+    Syncs product data with the database, returns the new frame if it changed.
+    """
+    version = product_data_sync.version
+    product_data_sync.refresh(connection_pool, force=True)
+    frame, new_version = product_data_sync.shared()
+
+    return frame if new_version != version else None
+
+
+def get_product_data() -> Tuple[pd.DataFrame, int]:
+    """
+    Serves product data from its local snapshot on a cold start and
+    syncs it with the database in the background.
+
+    Returns the product frame shared read-only by all sessions and its version.
+    """
+    metrics.set_gauge("snapshot_age_seconds", snapshot_store.age('product_data'), table='product_data')
+
+    if product_data_sync.frame is None:
+        snapshot = snapshot_store.get('product_data')
+        if snapshot is not None:
+            product_data_sync.seed(snapshot)
+        elif OFFLINE_MODE:
+            st.error("No local snapshot of product_data available in offline mode.")
+            stop_rerun()
+        else:
+            product_data_sync.refresh(connection_pool)
+            snapshot_store.put('product_data', product_data_sync.shared()[0])
+
+    sync_interval = product_data_sync.min_interval
+    if change_listener is not None and change_listener.connected:
+        sync_interval = NOTIFIED_SNAPSHOT_MAX_AGE
+
+    if not OFFLINE_MODE and time.monotonic() - product_data_sync.last_sync >= sync_interval:
+        snapshot_store.refresh_async('product_data', sync_product_data)
+
+    return product_data_sync.shared()
+
+
+@st.cache_resource
+def init_change_listener() -> Optional[TableChangeListener]:
+    """
+    Listens to change notifications of the database and refreshes the changed tables
+    right away, shared by all sessions. None if change notifications are disabled.
+    """
+    if OFFLINE_MODE or not CHANGE_NOTIFICATIONS:
+        return None
+
+    listener = TableChangeListener(lambda: psycopg2.connect(**st.secrets["postgres"]),
+                                   {table: (lambda table=table: refresh_table(table)) for table in WATCHED_TABLES},
+                                   # Changes made while disconnected were not notified
+                                   on_connect=lambda: [refresh_table(table) for table in WATCHED_TABLES])
+    listener.start()
+
+    return listener
+
+
+@st.cache_resource
+def init_product_data_sync():
+    """
+    Product data shared by all sessions, kept up to date by fetching only changed rows.
+    """
+    return ProductDataSync()
+
+
+@instrument_cache("get_stats_index", st.cache_resource(ttl=7200))
+def get_stats_index(_product_data_df: pd.DataFrame, product_data_version: int) -> Dict[str, Any]:
+    """
+    Emission statistics of all products, categories and subcategories,
+    built once per product data version and shared by all sessions.
+    """
+    return build_stats_index(_product_data_df)
+
+
+@instrument_cache("get_search_index", st.cache_resource(ttl=7200))
+def get_search_index(_product_data_df: pd.DataFrame, product_data_version: int) -> ProductSearchIndex:
+    """
+    Product search index of the whole catalog, built once per product data version
+    and shared by all sessions.
+    """
+    return ProductSearchIndex(_product_data_df)
+
+
+@instrument_cache("get_compensation_matrix", st.cache_resource(ttl=7200))
+def get_compensation_matrix(_product_data_df: pd.DataFrame, product_data_version: int,
+                            sun_hours: float, water_flow: float) -> pd.DataFrame:
+    """
+    Days needed per compensation method for every product in the catalog.
+
+    Built once per weather snapshot (sun_hours, water_flow) and product data version
+    and invalidated when one of them changes. The product frame itself is not hashed.
+    The matrix is shared read-only by all sessions.
+    """
+    return calc_compensation_days_matrix(_product_data_df['emission'], sun_hours, water_flow)
+
+
+@st.cache_resource
+def init_asset_bundle():
+    """
+    Texts and pre-resized images of the app, prepared once and shared by all sessions.
+    """
+    bundle = AssetBundle()
+    if not OFFLINE_MODE:
+        bundle.load_backgrounds_async()
 
-@st.cache_data(ttl=7200)
-def get_data_from_db(query):
-    return pd.read_sql_query(query, conn)
+    return bundle
+
+
+@instrument_cache("get_seasonal_profiles", st.cache_data(ttl=SNAPSHOT_MAX_AGE))
+def get_seasonal_profiles() -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Seasonal profiles of the sun hours and the Aare flow per day of the year,
+    built from the history tables. None if there is no history available.
+    """
+    try:
+        history = get_tables(['sun_hours_history', 'hydro_history'], required=False)
+        sun_hours_history, hydro_history = history['sun_hours_history'], history['hydro_history']
+    except (psycopg2.Error, pd.errors.DatabaseError, TimeoutError) as e:
+        logger.warning("History tables not available: %s", e)
+        return None
+
+    if sun_hours_history is None or hydro_history is None or sun_hours_history.empty or hydro_history.empty:
+        return None
+
+    return (build_seasonal_profile(sun_hours_history['date'], sun_hours_history['sum'] / 60),
+            build_seasonal_profile(hydro_history['date'], hydro_history['aare_flow']))
+
+
+@instrument_cache("get_seasonal_compensation_matrix", st.cache_resource(ttl=7200))
+def get_seasonal_compensation_matrix(_product_data_df: pd.DataFrame, product_data_version: int,
+                                     sun_hours_profile: np.ndarray, flow_rate_profile: np.ndarray,
+                                     start_day: int) -> pd.DataFrame:
+    """
+    Days needed per compensation method for every product in the catalog when the daily
+    offset follows the seasonal profiles from start_day (day of the year) on.
+    Built once per day, profiles and product data version.
+    """
+    seasonal_offsets = build_seasonal_offsets(sun_hours_profile, flow_rate_profile, start_day)
+
+    return calc_compensation_days_seasonal(_product_data_df['emission'], seasonal_offsets)
 
 
 # --- Functions ---
 
+# Number of products shown in the emission comparison of the selected product
+COMPARISON_WINDOW = 30
+
+# Number of products per page of the product picker
+PICKER_PAGE_SIZE = 50
+
 def init_session_state():
     """
      Initializes Streamlit Session State
@@ -38,20 +323,49 @@ def init_session_state():
     if "product_query" not in st.session_state:
         st.session_state["product_query"] = set()
 
+    # Product IDs in the basket -> quantity, the version changes whenever items are added or removed
+    if "basket" not in st.session_state:
+        st.session_state["basket"] = {}
+        st.session_state["basket_version"] = 0
+
 
-def query_data(df: pd.DataFrame) -> pd.DataFrame:
+@instrument_cache("get_product_colors", st.cache_resource(ttl=7200, max_entries=64))
+def get_product_colors(_product_data_df: pd.DataFrame, _view_positions: np.ndarray, product_data_version: int,
+                       categories: Optional[Tuple[str, ...]], subcategories: Optional[Tuple[str, ...]],
+                       zoom: Optional[Tuple], color_level: str) -> Tuple:
     """
-    Apply filters in Streamlit Session State
-    to filter the input DataFrame.
+    Colors of the products in view (see build_colors), shared by all sessions.
+    The products in view are determined by the data version, the filters and the zoom.
     """
-    df["emission_weight"] = df['emission'].astype(str) + "-" + df['weight_gram'].astype(int).astype(str)
+    return build_colors(_product_data_df, _view_positions, color_level)
 
-    df["selected"] = True
 
-    if st.session_state["product_query"]:
-        df.loc[~df['emission_weight'].isin(st.session_state["product_query"]), "selected"] = False
+@instrument_cache("get_base_product_fig", st.cache_resource(ttl=7200, max_entries=32))
+def get_base_product_fig(_product_data_df: pd.DataFrame, _view_positions: np.ndarray, _colors: Tuple,
+                         product_data_version: int, categories: Optional[Tuple[str, ...]],
+                         subcategories: Optional[Tuple[str, ...]], zoom: Optional[Tuple], color_level: str,
+                         filter_level: str, render_mode: str):
+    """
+    Product chart without selection (see build_base_fig), shared read-only by all sessions,
+    which only keep the patch of their selection.
+    """
+    return build_base_fig(_product_data_df, _view_positions, _colors, filter_level, render_mode)
 
-    return df
+
+def get_session_pipeline() -> Pipeline:
+    """
+    Product pipeline of the session, its memoized stages are kept between reruns.
+    The colors and the base figure are taken from the caches shared by all sessions.
+    """
+    if "pipeline" not in st.session_state:
+        pipeline = build_product_pipeline()
+        view_inputs = ['catalog_version', 'categories', 'subcategories', 'zoom', 'color_level']
+        pipeline.add_stage('colors', get_product_colors, ['catalog', 'view_positions', *view_inputs])
+        pipeline.add_stage('base_fig', get_base_product_fig,
+                           ['catalog', 'view_positions', 'colors', *view_inputs, 'filter_level', 'view_render_mode'])
+        st.session_state["pipeline"] = pipeline
+
+    return st.session_state["pipeline"]
 
 
 def update_state(current_query: Dict[str, Set]):
@@ -67,91 +381,103 @@ def update_state(current_query: Dict[str, Set]):
         rerun = True
 
     if rerun:
-        st.experimental_rerun()
+        restart_rerun()
+
+
+def add_to_basket(product_ids: List):
+    """
+    Adds one unit of every product to the basket in Streamlit Session State.
+    """
+    basket = st.session_state["basket"]
+    for product_id in product_ids:
+        basket[product_id] = basket.get(product_id, 0) + 1
+
+    st.session_state["basket_version"] += 1
+
+
+def update_basket(quantities: pd.Series):
+    """
+    Stores the edited quantities of the basket, items with a quantity of 0 are removed.
+    """
+    quantities = quantities.fillna(0).astype(int)
+    st.session_state["basket"] = {product_id: quantity for product_id, quantity in quantities.items()
+                                  if quantity > 0}
+
+    if (quantities <= 0).any():
+        st.session_state["basket_version"] += 1
+        restart_rerun()
 
 
 # --- Time bars / Async functions ---
-async def time_passed(max_t: float, time_waiting: float):
-    with col5:
-        t = 0
-        co2 = emission
-        st.markdown("##### Compensation amount:")
-        st.markdown(f"{co2} Kg/CO₂")
-        st.markdown("##### Time passed by: ")
-        placeholder = st.empty()
-        final_time = st.empty()
-
-        while t < max_t:
-            with placeholder.container():
-                days = t
-                months = days // 30
-                remaining_days = days % 30
-
-                st.markdown(f"##### **{int(months)} months {remaining_days} days**")
-                t += 1  # update time by 1 day
-                await asyncio.sleep(time_waiting)
-                placeholder.empty()
-
-        with final_time.container():
-            months = max_t // 30  # type: ignore
-            days = round(max_t % 30)  # type: ignore
-            st.markdown(f"##### **{int(months)} months {days} days**")
-
-
-async def compensation_bar(t_compensation: float, time_waiting: float, title: str,
-                           column, help_string: str):
-    months = round(t_compensation // 30)
-    days = round(t_compensation % 30)
-    t = 0
+def init_time_passed(column):
+    """
+    Shows the compensation amount and returns the placeholder of the passed time.
+    """
+    column.markdown("##### Compensation amount:")  # type: ignore
+    column.markdown(f"{emission} Kg/CO₂")  # type: ignore
+    column.markdown("##### Time passed by: ")  # type: ignore
+
+    return column.empty()  # type: ignore
 
-    column.markdown(title, help=help_string)  # type: ignore
-    column.markdown(f"{months} months {days} days")  # type: ignore
-    progress_bar = column.progress(0)  # type: ignore
 
-    while t < t_compensation:
-        t += 1
-        percent_complete = round(t / t_compensation * 100)
+def init_compensation_bar(t_compensation: float, title: str, column, help_string: str):
+    """
+    Shows the compensation time and returns its progress bar,
+    None if the method can not offset under current conditions.
+    """
+    column.markdown(title, help=help_string)  # type: ignore
 
-        if percent_complete > 100:
-            percent_complete = 100
-            t = t_compensation  # type: ignore
+    if not np.isfinite(t_compensation):
+        column.markdown("No offset possible under current conditions")  # type: ignore
+        return None
 
-        await asyncio.sleep(time_waiting)
-        progress_bar.progress(percent_complete, text=f"{percent_complete} %")
+    column.markdown(format_days(t_compensation))  # type: ignore
 
+    return column.progress(0)  # type: ignore
 
-async def async_main(sun_hours: float, num_trees: int, water_flow: float):
-    tree_compensation = calc_trees_offset(num_trees)
-    hydro_compensation = calc_hydro_offset(water_flow)
-    solar_compensation = calc_solar_energy_offset(sun_hours)
 
-    tree_info = read_markdown('assets/tree_calc_info.md')
-    hydro_info = read_markdown('assets/hydro_calc_info.md')
-    solar_info = read_markdown('assets/solar_calc_info.md')
+@timed_stage("async_main")
+async def async_main(compensation_days: pd.Series):
+    tree_info = asset_bundle.text('tree_calc_info.md')
+    hydro_info = asset_bundle.text('hydro_calc_info.md')
+    solar_info = asset_bundle.text('solar_calc_info.md')
 
-    if emission:
-        t_tree = emission / tree_compensation
-        t_hydro = emission / hydro_compensation
-        t_solar = emission / solar_compensation
-        max_t = max(t_tree, t_hydro, t_solar)
+    if compensation_days is not None:
+        t_tree = compensation_days['trees']
+        t_hydro = compensation_days['hydro']
+        t_solar = compensation_days['solar']
+        max_t = max((t for t in (t_tree, t_hydro, t_solar) if np.isfinite(t)), default=None)
+        if max_t is None:
+            st.info("None of the compensation methods can offset this emission under current conditions, "
+                    "so there is no time comparison to show.")
+            return
 
         if max_t <= 720:
             time_waiting = 0.2
         else:
             time_waiting = max_t / (max_t ** 1.7)
 
-        await asyncio.gather(time_passed(max_t, time_waiting),
-                             compensation_bar(t_tree, time_waiting, "#### 🌳 One Trees", col6, tree_info),
-                             compensation_bar(t_solar, time_waiting, "#### ☀️ One Solar Panel (1.767 m x 1.041 m)",
-                                              col7, solar_info),
-                             compensation_bar(t_hydro, time_waiting,
-                                              "#### 🌊 Water wheel Aare (2m x 1m)",
-                                              col8, hydro_info))
+        time_placeholder = init_time_passed(col5)
+        progress_bars = [init_compensation_bar(t_tree, "#### 🌳 One Trees", col6, tree_info),
+                         init_compensation_bar(t_solar, "#### ☀️ One Solar Panel (1.767 m x 1.041 m)",
+                                               col7, solar_info),
+                         init_compensation_bar(t_hydro, "#### 🌊 Water wheel Aare (2m x 1m)",
+                                               col8, hydro_info)]
 
-        stop_flag = st.session_state.get("stop_flag", False)
+        # All bars are driven by one loop with a fixed frame budget, every frame
+        # is computed in closed form instead of advancing one day per update
+        frame_days, frame_interval = plan_animation_frames(max_t, time_waiting)
+        frame_percentages = calc_frame_percentages(frame_days, [t_tree, t_solar, t_hydro])
 
-        if stop_flag:
-            st.stop()
+        # Clicking "Stop time comparison" reruns the script, Streamlit interrupts
+        # this loop at its next update and the rerun does not start the animation again
+        for day, percentages in zip(frame_days, frame_percentages):
+            time_placeholder.markdown(f"##### **{format_days(day)}**")
+            for progress_bar, percent_complete in zip(progress_bars, percentages):
+                if progress_bar is not None:
+                    progress_bar.progress(int(percent_complete), text=f"{percent_complete} %")
+
+            await asyncio.sleep(frame_interval)
 
     else:
         st.warning("Please select a product!")
@@ -160,28 +486,32 @@ async def async_main(sun_hours: float, num_trees: int, water_flow: float):
 ##### INITIALIZE AND GET DATA #####
 init_session_state()
 
-conn = init_connection()
+connection_pool = init_connection_pool()
+asset_bundle = init_asset_bundle()
+snapshot_store = init_snapshot_store()
+change_listener = init_change_listener()
 
 # Get data
-product_data_df = get_data_from_db("""SELECT * FROM product_data WHERE emission != 0;""")
-weather_data_df = get_data_from_db("""SELECT * FROM current_weather;""")
-sun_hours = get_data_from_db("""SELECT * FROM sun_hours""")
-hydro_data_df = get_data_from_db("""SELECT * FROM current_hydro_data;""")
-
-# If weather data does not consist of data for data anymore (not extracted anymore) take max date
-if weather_data_df.empty:
-    weather_data_df = get_data_from_db("""SELECT * FROM last_weather_data;""")
+product_data_sync = init_product_data_sync()
+with stage_timer("load_data"), ThreadPoolExecutor(max_workers=1) as table_executor:
+    # On a cold start the live tables are loaded from the database while the product data loads
+    prefetched_tables = prefetch_tables(LIVE_TABLES, table_executor)
+    product_data_df, product_data_version = get_product_data()
+    live_tables = get_tables(LIVE_TABLES, prefetched=prefetched_tables)
 
+weather_data_df = live_tables['current_weather']
+sun_hours = live_tables['sun_hours']
+hydro_data_df = live_tables['current_hydro_data']
 
-# If sun hours data does not consist of data for data anymore (not extracted anymore) take max date data
-if sun_hours['sum'].iloc[0] is None:
-    sun_hours = get_data_from_db("""SELECT * FROM last_sun_hours_data;""")
+sun_hours_today = round(sun_hours['sum'].iloc[0] / 60, 2)
+current_water_flow = hydro_data_df['aare_flow'].iloc[0]
 
-# Cleaning - Remove symbols in name that might disrupt filtering dropdown section
-product_data_df['name'] = product_data_df['name'].apply(lambda x: x.replace("-", "").replace("/", "").replace("\\", ""))
+# Emission statistics of the whole catalog
+stats_index = get_stats_index(product_data_df, product_data_version)
 
-# Create copy of data frame to also filter for category of product
-product_filter_df = product_data_df.copy()
+# Compensation days of the whole catalog for the current weather snapshot
+compensation_matrix = get_compensation_matrix(product_data_df, product_data_version,
+                                              sun_hours_today, current_water_flow)
 
 
 ##### SIDEBAR #####
@@ -189,7 +519,7 @@ auto_background = st.sidebar.checkbox("Automatically change background based on
                                       value=True)
 if auto_background:
     current_weather = weather_data_df['condition'].iloc[0]
-    assign_weather_background(weather_condition=current_weather)
+    assign_weather_background(weather_condition=current_weather, asset_bundle=asset_bundle)
 
 else:
     checkbox = st.sidebar.checkbox("Apply weather background",
@@ -199,7 +529,7 @@ else:
         # Temporary to display
         weather = st.sidebar.selectbox("Choose weather to display",
                                        ['sun', 'covered', 'rain', 'snow'])
-        assign_weather_background(weather_condition=weather)
+        assign_weather_background(weather_condition=weather, asset_bundle=asset_bundle)
 
 
 
@@ -210,7 +540,7 @@ else:
 st.markdown("# 💨 🌍 Contextualizing CO₂-Emissions")
 
 # Read lead text
-lead_text = read_markdown('assets/lead_text.md')
+lead_text = asset_bundle.text('lead_text.md')
 
 st.markdown(lead_text)
 
@@ -218,18 +548,18 @@ st.markdown(lead_text)
 col1, col2 = st.columns(2)
 
 col1.metric("📁 Products in database:",
-            f"{len(product_data_df)} products")
+            f"{stats_index['all'].count} products")
 
 col2.metric("🎨 Categories in database:",
-            f"{product_data_df['category'].nunique()} categories")
+            f"{len(stats_index['category'])} categories")
 
 col3, col4 = st.columns(2)
 
 col3.metric("🌱 Lowest emission of product:",
-            f"{min(product_data_df['emission'])} Kg/CO₂")
+            f"{stats_index['all'].min} Kg/CO₂")
 
 col4.metric("💨 Highest emission of product:",
-            f"{max(product_data_df['emission'])} Kg/CO₂")
+            f"{stats_index['all'].max} Kg/CO₂")
 
 st.markdown("---")
 
@@ -244,62 +574,117 @@ st.markdown("Filter for the product you would like to inspect more closely. "
             "selecting it in the dropdown below the chart.")
 category_filter = st.checkbox("Check to filter for specific categories")
 
+# Filters select positions in the shared catalog, None means no filter
+selected_categories: Optional[List[str]] = None
+selected_subcategories: Optional[List[str]] = None
+
 if category_filter:
 
     sorted_categories = sorted(product_data_df['category'].unique())
     sorted_categories.insert(0, "All categories")
 
-    selected_categories: List[str] = st.multiselect("Select the categories you are interested in",
-                                                    sorted_categories,
-                                                    default="All categories")
+    category_choice: List[str] = st.multiselect("Select the categories you are interested in",
+                                                sorted_categories,
+                                                default="All categories")
 
-    if "All categories" not in selected_categories:
-        product_data_df = product_data_df[product_data_df['category'].isin(selected_categories)]
+    if "All categories" not in category_choice:
+        selected_categories = category_choice
 
 subcategory_filter = st.checkbox("Check to filter for specific subcategories")
 
 if subcategory_filter:
-    sorted_categories = sorted(product_data_df['detailed_category'].unique())
-    sorted_categories.insert(0, "All subcategories")
+    subcategories = product_data_df['detailed_category']
+    if selected_categories is not None:
+        subcategories = subcategories[product_data_df['category'].isin(selected_categories)]
 
-    selected_subcategories: List[str] = st.multiselect("Select the subcategories you are interested in",
-                                                    sorted_categories,
-                                                    default="All subcategories")
-
-    if "All subcategories" not in selected_subcategories:
-        product_data_df = product_data_df[product_data_df['detailed_category'].isin(selected_subcategories)]
+    sorted_categories = sorted(subcategories.unique())
+    sorted_categories.insert(0, "All subcategories")
 
-product_data_df = query_data(product_data_df)
+    subcategory_choice: List[str] = st.multiselect("Select the subcategories you are interested in",
+                                                   sorted_categories,
+                                                   default="All subcategories")
+
+    if "All subcategories" not in subcategory_choice:
+        selected_subcategories = subcategory_choice
+
+# Stages from the catalog to the chart, memoized per session on their inputs,
+# so e.g. a new chart selection does not filter or zoom the products again
+pipeline = get_session_pipeline()
+pipeline_sources = {'catalog': product_data_df,
+                    'categories': tuple(selected_categories) if selected_categories is not None else None,
+                    'subcategories': tuple(selected_subcategories) if selected_subcategories is not None else None,
+                    'catalog_version': product_data_version}
+pipeline_keys = {'catalog': product_data_version}
+
+# Very large catalogs are shown as density, zooming into a region drills into single products
+zoom = None
+render_mode, value_ranges = pipeline.run(['render_mode', 'value_ranges'], pipeline_sources, pipeline_keys).values()
+
+if render_mode == 'density':
+    zoom_col1, zoom_col2 = st.columns(2)
+    min_emission, max_emission = value_ranges['emission']
+    min_weight, max_weight = value_ranges['weight_gram']
+
+    emission_range = zoom_col1.slider("Zoom into emission range (Kg/CO₂)", min_emission, max_emission,
+                                      (min_emission, max_emission))
+    weight_range = zoom_col2.slider("Zoom into weight range (gram)", min_weight, max_weight,
+                                    (min_weight, max_weight))
+    zoom = (tuple(emission_range), tuple(weight_range))
 
 if subcategory_filter:
-    category_color_list, category_color_legend_list = create_color_list(product_data_df, 'detailed_category')
+    color_level = 'detailed_category'
     filter_level = 'Subcategory'
 else:
-    category_color_list, category_color_legend_list = create_color_list(product_data_df, 'category')
+    color_level = 'category'
     filter_level = 'Category'
 
-product_fig = build_product_data_fig(product_data_df, category_color_list, level=filter_level)
-
-legend_html = create_color_legend(category_color_legend_list, level=filter_level)
+pipeline_results = pipeline.run(['view_render_mode', 'view_positions', 'product_fig', 'legend_html',
+                                 'picker_ids'],
+                                {**pipeline_sources,
+                                 'zoom': zoom,
+                                 'selection': frozenset(st.session_state["product_query"]),
+                                 'color_level': color_level,
+                                 'filter_level': filter_level},
+                                pipeline_keys)
+view_positions = pipeline_results['view_positions']
+product_fig = pipeline_results['product_fig']
+
+if pipeline_results['view_render_mode'] == 'density':
+    st.plotly_chart(product_fig)
+    selected_points = []
 
-# Render the legend in Streamlit
-st.markdown(legend_html, unsafe_allow_html=True)
+else:
+    # Render the legend in Streamlit
+    st.markdown(pipeline_results['legend_html'], unsafe_allow_html=True)
 
-selected_points = plotly_events(product_fig,
-                                select_event=True,
-                                key=f"product_{st.session_state.counter}")
+    selected_points = plotly_events(product_fig,
+                                    select_event=True,
+                                    key=f"product_{st.session_state.counter}")
 
-# Update session state
-current_query = {"product_query": {f"{el['x']}-{el['y']}" for el in selected_points}}
+# Update session state, selected points are resolved to product IDs by their point index
+point_indices = [el['pointIndex'] for el in selected_points if 0 <= el['pointIndex'] < len(view_positions)]
+current_query = {"product_query": set(product_data_df.index[view_positions[point_indices]].tolist())}
 update_state(current_query)
 
-# Dropdown selection
-product_data_df = product_data_df[product_data_df['selected'] == True]
-product_data_df['price_str'] = product_data_df['price'].apply(lambda x: f"CHF {str(x)}0")
-product_zip = list(zip(product_data_df['name'], product_data_df['category'], product_data_df['price_str']))
-choices = sorted([" - ".join(product) for product in product_zip])
+# Dropdown selection, only one page of matching products is sent to the browser
+picker_ids = pipeline_results['picker_ids']
+search_index = get_search_index(product_data_df, product_data_version)
+
+# Restrict the search to the filtered products, unless all products are left
+allowed_ids = None if len(picker_ids) == len(product_data_df) else picker_ids
 
-product_choice = st.selectbox("Choose product", choices)
+search_query = st.text_input("Search product by name, category or price")
+product_choices, num_matches = search_index.search(search_query, limit=PICKER_PAGE_SIZE, allowed_ids=allowed_ids)
+
+num_pages = math.ceil(num_matches / PICKER_PAGE_SIZE)
+if num_pages > 1:
+    page = st.number_input(f"{num_matches} products found, page (of {num_pages})",
+                           min_value=1, max_value=num_pages, value=1)
+    if page > 1:
+        product_choices, _ = search_index.search(search_query, limit=PICKER_PAGE_SIZE,
+                                                 offset=(page - 1) * PICKER_PAGE_SIZE, allowed_ids=allowed_ids)
+
+product_choice = st.selectbox("Choose product", product_choices.tolist(), format_func=search_index.label)
 
 st.markdown("---")
 
@@ -307,10 +692,8 @@ st.markdown("---")
 
 ##### Product metrics #####
 
-if product_choice:
-    selected_product = product_data_df[(product_data_df['name'] == product_choice.split(" - ")[0]) & \
-                                       (product_data_df['price'] == float(
-                                           product_choice.replace("CHF ", "").split(" - ")[2]))].iloc[0, :]
+if product_choice is not None:
+    selected_product = product_data_df.loc[product_choice]
     st.markdown(f"### 📝 {selected_product['name']} ({selected_product['detailed_category']})")
     st.markdown("Please find below more detailed information about the product you selected.")
     st.markdown(f"Category: {selected_product['category']}")
@@ -330,9 +713,9 @@ if product_choice:
         aggregation = 'category'
         filter_cat = 'category'
 
-    cat = str(selected_product.loc[aggregation])
-    cat_df = product_filter_df[product_filter_df[aggregation] == cat]
-    avg_emission = cat_df['emission'].mean()
+    cat = selected_product.loc[aggregation]
+    cat_stats = stats_index[aggregation][cat]
+    avg_emission = cat_stats.mean
     delta_emission_pct = round(((selected_product['emission'] / avg_emission - 1) * 100), 1)
     high_or_low_text = "higher" if delta_emission_pct > 0 else "lower"
     delta_text = f"""{delta_emission_pct}% {high_or_low_text} to avg. in {filter_cat}"""
@@ -341,9 +724,18 @@ if product_choice:
                 delta=delta_text,
                 delta_color='inverse')
 
+    percentile_rank = calc_percentile_rank(cat_stats, selected_product['emission'])
+    st.markdown(f"📊 {round(percentile_rank, 1)}% of the products in this {filter_cat} "
+                f"have a lower emission than your product.")
+
     emission: float = float(selected_product['emission'])
 
-    emission_comparison_fig = build_product_comparison_fig(selected_product, cat_df, category_level=aggregation)
+    # Only the products nearest by emission rank are compared
+    window_ids = get_emission_window(cat_stats.emissions, cat_stats.product_ids, selected_product.name,
+                                     selected_product['emission'], k=COMPARISON_WINDOW)
+    window_df = product_data_df.loc[window_ids]
+
+    emission_comparison_fig = build_product_comparison_fig(selected_product, window_df, category_level=aggregation)
 
     st.plotly_chart(emission_comparison_fig)
 
@@ -351,6 +743,68 @@ st.markdown("---")
 
 
 
+##### Basket #####
+
+st.markdown("### 🧺 Basket")
+st.markdown("Add products to your basket to see their total emission, how long it takes to compensate "
+            "for it and which products contribute most. Set the quantity of a product to 0 to remove it.")
+
+if product_choice is not None:
+    if st.button("Add chosen product to basket"):
+        add_to_basket([product_choice])
+
+if st.session_state["product_query"]:
+    if st.button(f"Add the {len(st.session_state['product_query'])} products selected in the chart to basket"):
+        add_to_basket(sorted(st.session_state["product_query"]))
+
+# Products removed from the catalog in the meantime are dropped
+basket_ids = product_data_df.index.intersection(list(st.session_state["basket"]))
+
+if len(basket_ids):
+    basket_df = product_data_df.loc[basket_ids, ['name', 'category', 'emission']]
+    basket_df['quantity'] = [st.session_state["basket"][product_id] for product_id in basket_ids]
+
+    # All quantities are edited in one widget, the editor is reset when items are added or removed.
+    # The editor can not lock single columns, so it only holds the quantities and the products are
+    # listed next to it under the same row numbers (a range index is not editable).
+    numbered_basket_df = basket_df.reset_index(drop=True)
+    basket_products_col, basket_quantities_col = st.columns([3, 1])
+    basket_products_col.dataframe(numbered_basket_df[['name', 'category', 'emission']], use_container_width=True)
+    edited_quantities = basket_quantities_col.experimental_data_editor(
+        numbered_basket_df[['quantity']], use_container_width=True,
+        key=f"basket_{st.session_state['basket_version']}")['quantity']
+    edited_quantities.index = basket_ids
+    update_basket(edited_quantities)
+    basket_df['quantity'] = edited_quantities.astype(int)
+
+    basket_items_df, basket_totals = calc_basket_compensation(basket_df['emission'], basket_df['quantity'],
+                                                              sun_hours_today, current_water_flow)
+    basket_items_df[['name', 'quantity']] = basket_df[['name', 'quantity']]
+
+    basket_col1, basket_col2 = st.columns(2)
+    basket_col1.metric("🧺 Products in basket:", f"{basket_df['quantity'].sum()} products")
+    basket_col2.metric("💨 Total emission:", f"{round(basket_totals['emission'], 2)} Kg/CO₂")
+
+    basket_method_cols = st.columns(len(COMPENSATION_METHODS))
+    for column, method, title in zip(basket_method_cols, COMPENSATION_METHODS,
+                                     ["🌳 One Tree", "☀️ One Solar Panel", "🌊 Water wheel Aare"]):
+        days = basket_totals[method]
+        column.metric(title, format_days(days) if np.isfinite(days) else "No offset possible")
+
+    st.plotly_chart(build_basket_share_fig(basket_items_df))
+
+    if st.button("Empty basket"):
+        st.session_state["basket"] = {}
+        st.session_state["basket_version"] += 1
+        restart_rerun()
+
+else:
+    st.info("Your basket is empty.")
+
+st.markdown("---")
+
+
+
 ##### Weather section #####
 
 st.markdown("### 🌤️ 💧 Weather and Aare information")
@@ -363,7 +817,6 @@ col7, col8 = st.columns(2)
 col7.metric("🌡️ Temperature:",
             f"{weather_data_df['TTT_C'].iloc[0]} °C")
 
-sun_hours_today = round(sun_hours['sum'].iloc[0] / 60, 2)
 col8.metric("☀️⌛ Sun hours",
             f"{sun_hours_today} hours")
 
@@ -374,7 +827,6 @@ col9, col10 = st.columns(2)
 col9.metric("🌡️ Temperature:",
             f"{hydro_data_df['aare_temp'].iloc[0]} °C")
 
-current_water_flow = hydro_data_df['aare_flow'].iloc[0]
 col10.metric("🌊 Water flow",
              f"{current_water_flow} m3/s")
 
@@ -386,21 +838,35 @@ st.markdown("---")
 
 st.markdown("### ♻️⌛ How long does it take to compensate/offset for the emission?")
 
-time_comp_lead_text = read_markdown('assets/offset_comparison_lead.md')
+time_comp_lead_text = asset_bundle.text('offset_comparison_lead.md')
 st.markdown(time_comp_lead_text)
 
+# With history available the daily offset can follow the seasons instead of today's weather
+seasonal_profiles = get_seasonal_profiles()
+seasonal_mode = False
+if seasonal_profiles is not None:
+    seasonal_mode = st.radio("Base the compensation time on",
+                             ["Today's weather", "Seasonal weather from today on (historical average)"],
+                             horizontal=True) != "Today's weather"
+
 button = st.button("See time needed per compensation method")
 
 if button:
-    stop_button = st.button("Stop time comparison", key="stop_button")
-    if stop_button:
-        st.stop()
+    # Only its rerun is needed, see async_main
+    st.button("Stop time comparison", key="stop_button")
     col5, col6 = st.columns(2)
     col7, col8 = st.columns(2)
 
-    asyncio.run(async_main(sun_hours=sun_hours_today,
-                           num_trees=1,
-                           water_flow=current_water_flow))
+    if seasonal_mode:
+        # Feb 29 counts as Mar 1 in the seasonal profiles
+        today = pd.Timestamp.today()
+        start_day = today.dayofyear - 1 - int(today.is_leap_year and today.month > 2)
+        time_matrix = get_seasonal_compensation_matrix(product_data_df, product_data_version,
+                                                       *seasonal_profiles, start_day)
+    else:
+        time_matrix = compensation_matrix
+
+    asyncio.run(async_main(time_matrix.loc[selected_product.name] if product_choice is not None else None))
 
 
 st.markdown("---")
@@ -424,8 +890,7 @@ if chosen_method == 'Trees':
     create a greener environment, and build a sustainable future for Bern and beyond.
     """
     st.success(text)
-    image = Image.open('images/trees.jpg')
-    st.image(image, caption='Plant trees with company XYZ in Bern')
+    show_image(asset_bundle, 'trees', caption='Plant trees with company XYZ in Bern')
 
 elif chosen_method == 'Solar':
     text = """
@@ -436,8 +901,7 @@ elif chosen_method == 'Solar':
     renewable energy, lower carbon emissions, and pave the way for a greener future in the region.
     """
     st.success(text)
-    image = Image.open('images/solar.jpg')
-    st.image(image, caption='Fund solar panels in the canton of Bern')
+    show_image(asset_bundle, 'solar', caption='Fund solar panels in the canton of Bern')
 
 elif chosen_method == 'Hydro':
     text = """
@@ -450,8 +914,7 @@ elif chosen_method == 'Hydro':
         and resilient energy landscape in Bern.
         """
     st.success(text)
-    image = Image.open('images/hydro.jpeg')
-    st.image(image, caption='Support the generation of hydro power in Mühleberg')
+    show_image(asset_bundle, 'hydro', caption='Support the generation of hydro power in Mühleberg')
 
 else:
     st.info("Please choose a compensation method")
@@ -466,5 +929,12 @@ if chosen_method in ['Trees', 'Solar', 'Hydro']:
                    "world a better place. We appreciate your efforts to reduce your carbon footprint!")
 
 
+# Export pool usage and timings of this rerun
+for metric, value in connection_pool.metrics().items():
+    metrics.set_gauge(f"connection_pool_{metric}", value)
+
+rerun_profiler.finish()
+
+
 if __name__ == "__main__":
     pass
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from utils.animation_functions import plan_animation_frames, calc_frame_percentages, format_days, MAX_FRAMES
+
+
+def test_frames_keep_the_duration_within_the_frame_budget():
+    frame_days, frame_interval = plan_animation_frames(3650, 0.2)
+
+    assert len(frame_days) == MAX_FRAMES
+    assert frame_days[-1] == 3650
+    assert frame_interval * len(frame_days) == pytest.approx(3650 * 0.2)
+
+
+def test_short_animations_advance_at_most_one_day_per_frame():
+    frame_days, frame_interval = plan_animation_frames(5, 0.2)
+
+    assert frame_days.tolist() == [1, 2, 3, 4, 5]
+    assert frame_interval == pytest.approx(0.2)
+
+
+def test_frame_percentages_are_capped_and_impossible_methods_stay_at_zero():
+    percentages = calc_frame_percentages(np.array([10.0, 20.0, 40.0]), [40.0, 20.0, np.inf])
+
+    assert percentages.tolist() == [[25, 50, 0], [50, 100, 0], [100, 100, 0]]
+
+
+def test_format_days():
+    assert format_days(75.4) == "2 months 15 days"
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils.calc_co2_offset_functions import calc_solar_energy_offset, calc_solar_energy_offset_batch, \
+    calc_trees_offset, calc_trees_offset_batch, calc_hydro_offset, calc_hydro_offset_batch, \
+    calc_compensation_days_matrix, calc_basket_compensation, COMPENSATION_METHODS
+
+SUN_HOURS = np.r_[0, np.linspace(0, 16, 1601), 0.005, 7.3, 12.25]
+TREES = np.arange(0, 1001)
+FLOW_RATES = np.r_[0, np.linspace(0, 1500, 3001), 20.5, 113.7, 640.25]
+
+
+@pytest.mark.parametrize('scalar_func, batch_func, values', [
+    (calc_solar_energy_offset, calc_solar_energy_offset_batch, SUN_HOURS),
+    (calc_trees_offset, calc_trees_offset_batch, TREES),
+    (calc_hydro_offset, calc_hydro_offset_batch, FLOW_RATES),
+])
+def test_scalar_offsets_match_batch(scalar_func, batch_func, values):
+    batch = batch_func(values)
+    scalars = np.array([scalar_func(value) for value in values.tolist()])
+
+    assert isinstance(batch, np.ndarray)
+    np.testing.assert_array_equal(batch, scalars)
+
+
+def test_batch_offsets_take_series():
+    sun_hours = pd.Series([0.0, 4.5, 9.0], index=['a', 'b', 'c'])
+
+    np.testing.assert_array_equal(calc_solar_energy_offset_batch(sun_hours),
+                                  calc_solar_energy_offset_batch(sun_hours.to_numpy()))
+
+
+def test_compensation_days_keep_index_and_mark_impossible_methods():
+    emissions = pd.Series([1.0, 2.0], index=[10, 20])
+
+    days = calc_compensation_days_matrix(emissions, sun_hours=0, flow_rate=100)
+
+    assert list(days.index) == [10, 20]
+    assert list(days.columns) == COMPENSATION_METHODS
+    assert days.loc[20, 'trees'] == pytest.approx(2 * days.loc[10, 'trees'])
+    assert np.isinf(days['solar']).all()
+    assert days.loc[10, 'hydro'] == pytest.approx(1.0 / calc_hydro_offset(100))
+
+
+def test_basket_totals_are_the_sum_of_the_items():
+    items, totals = calc_basket_compensation(pd.Series([1.5, 0.5]), [2, 4], sun_hours=6, flow_rate=120)
+
+    assert totals['emission'] == pytest.approx(5.0)
+    assert items['share'].sum() == pytest.approx(1.0)
+    for method in COMPENSATION_METHODS:
+        assert items[method].sum() == pytest.approx(totals[method])
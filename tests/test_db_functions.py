@@ -0,0 +1,86 @@
+import sqlite3
+import pandas as pd
+import pytest
+from utils.db_functions import ConnectionPool, ProductDataSync
+
+
+def _products(rows):
+    return pd.DataFrame(rows, columns=['id', 'name', 'category', 'detailed_category', 'price',
+                                       'compensation_price', 'emission', 'weight_gram', 'updated_at'])
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / "products.db")
+    with sqlite3.connect(path) as conn:
+        _products([(1, 'Milk', 'Dairy', 'Milk', 1.5, 0.1, 1.2, 1000, '2023-01-01'),
+                   (2, 'Bread', 'Bakery', 'Bread', 3.2, 0.2, 0.8, 500, '2023-01-02'),
+                   (3, 'Cheese', 'Dairy', 'Cheese', 7.9, 0.5, 5.4, 250, '2023-01-03'),
+                   (4, 'Water', 'Drinks', 'Water', 0.9, 0.0, 0.0, 1500, '2023-01-03')]) \
+            .to_sql('product_data', conn, index=False)
+
+    return path
+
+
+@pytest.fixture
+def pool(db):
+    return ConnectionPool(lambda: sqlite3.connect(db), max_size=1)
+
+
+def _execute(db, query):
+    with sqlite3.connect(db) as conn:
+        conn.execute(query)
+
+
+def test_full_load_skips_products_without_emission(pool):
+    sync = ProductDataSync()
+    frame = sync.refresh(pool)
+
+    assert sorted(frame.index) == [1, 2, 3]
+    assert sync.watermark == '2023-01-03'
+    assert sync.version == 1
+
+
+def test_sync_selects_only_the_used_columns(db, pool):
+    _execute(db, "ALTER TABLE product_data ADD COLUMN description TEXT;")
+
+    frame = ProductDataSync().refresh(pool)
+
+    assert 'description' not in frame.columns
+    assert set(frame.columns) == {'id', 'name', 'category', 'detailed_category', 'price', 'compensation_price',
+                                  'emission', 'weight_gram', 'updated_at'}
+
+
+def test_delta_merges_updated_new_and_removed_rows(db, pool):
+    sync = ProductDataSync()
+    sync.refresh(pool)
+
+    _execute(db, "UPDATE product_data SET emission = 1.5, updated_at = '2023-02-01' WHERE id = 1;")
+    _execute(db, "UPDATE product_data SET emission = 0, updated_at = '2023-02-02' WHERE id = 2;")
+    _execute(db, "INSERT INTO product_data VALUES (5, 'Butter', 'Dairy', 'Butter', 2.5, 0.3, 9.0, 250, "
+                 "'2023-02-01');")
+
+    frame = sync.refresh(pool, force=True)
+
+    assert sorted(frame.index) == [1, 3, 5]
+    assert frame.loc[1, 'emission'] == 1.5
+    assert frame.loc[5, 'name'] == 'Butter'
+    assert sync.version == 2
+
+
+def test_watermark_includes_removed_rows(db, pool):
+    sync = ProductDataSync()
+    sync.refresh(pool)
+
+    # The newest change removes a product from the catalog
+    _execute(db, "UPDATE product_data SET emission = 0, updated_at = '2023-03-01' WHERE id = 3;")
+    sync.refresh(pool, force=True)
+
+    assert sync.watermark == '2023-03-01'
+    assert sync.version == 2
+
+    # Nothing changed since, so the removed row is not fetched again
+    sync.refresh(pool, force=True)
+
+    assert sync.version == 2
+    assert sorted(sync.frame.index) == [1, 2]
@@ -0,0 +1,155 @@
+import os
+import socket
+import time
+from collections import namedtuple
+import pytest
+from utils.notify_functions import CHANGE_CHANNEL, TableChangeListener, install_change_trigger
+
+# DSN of a local Postgres database the integration test may create tables in
+POSTGRES_DSN = os.environ.get('CO2_TEST_POSTGRES_DSN')
+
+Notify = namedtuple('Notify', ['pid', 'channel', 'payload'])
+
+
+class FakeConnection:
+    """
+    Stands in for a psycopg2 connection, notifications written with notify()
+    make the connection readable and are parsed into notifies by poll().
+    """
+
+    def __init__(self):
+        self._reader, self._writer = socket.socketpair()
+        self.autocommit = False
+        self.executed = []
+        self.notifies = []
+        self.closed = False
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def notify(self, *tables):
+        self._writer.sendall("".join(f"{table}\n" for table in tables).encode())
+
+    def poll(self):
+        data = self._reader.recv(4096)
+        if not data:
+            raise ConnectionError("connection closed")
+        self.notifies.extend(Notify(1, CHANGE_CHANNEL, table) for table in data.decode().split())
+
+    def drop(self):
+        self._writer.close()
+
+    def close(self):
+        self.closed = True
+        self._reader.close()
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query):
+        self.conn.executed.append(query)
+
+    def close(self):
+        pass
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting for the listener")
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def listen():
+    listeners = []
+
+    def start(connect_func, tables=('product_data', 'current_weather', 'sun_hours', 'current_hydro_data')):
+        calls = []
+        listener = TableChangeListener(connect_func,
+                                       {table: (lambda table=table: calls.append(table)) for table in tables},
+                                       on_connect=lambda: calls.append('reconnect'),
+                                       poll_timeout=0.05, reconnect_delay=0.05)
+        listener.start()
+        listeners.append(listener)
+        return listener, calls
+
+    yield start
+
+    for listener in listeners:
+        listener.stop()
+        listener._thread.join(timeout=5)
+
+
+def test_only_changed_tables_are_refreshed(listen):
+    conn = FakeConnection()
+    listener, calls = listen(iter([conn]).__next__)
+    _wait_for(lambda: listener.connected)
+
+    assert conn.autocommit
+    assert conn.executed == [f"LISTEN {CHANGE_CHANNEL};"]
+    assert calls == ['reconnect']
+
+    # Notifications arriving together are handled once per table, unknown tables are ignored
+    conn.notify('sun_hours', 'product_data', 'sun_hours', 'unknown_table')
+    _wait_for(lambda: len(calls) == 3)
+
+    conn.notify('current_weather')
+    _wait_for(lambda: len(calls) == 4)
+
+    assert calls == ['reconnect', 'product_data', 'sun_hours', 'current_weather']
+
+
+def test_reconnects_and_refreshes_after_connection_loss(listen):
+    first, second = FakeConnection(), FakeConnection()
+    listener, calls = listen(iter([first, second]).__next__)
+    _wait_for(lambda: listener.connected)
+
+    first.drop()
+    _wait_for(lambda: calls.count('reconnect') == 2 and listener.connected)
+    assert first.closed
+
+    second.notify('current_hydro_data')
+    _wait_for(lambda: 'current_hydro_data' in calls)
+
+    assert calls == ['reconnect', 'reconnect', 'current_hydro_data']
+
+
+@pytest.mark.skipif(not POSTGRES_DSN, reason="Set CO2_TEST_POSTGRES_DSN to run against a local Postgres")
+def test_postgres_trigger_refreshes_only_the_changed_table(listen):
+    psycopg2 = pytest.importorskip('psycopg2')
+    tables = ('test_notify_products', 'test_notify_weather')
+
+    conn = psycopg2.connect(POSTGRES_DSN)
+    cursor = conn.cursor()
+    try:
+        for table in tables:
+            cursor.execute(f"DROP TABLE IF EXISTS {table};")
+            cursor.execute(f"CREATE TABLE {table} (id integer PRIMARY KEY, value real);")
+            cursor.execute(f"INSERT INTO {table} VALUES (1, 0);")
+        conn.commit()
+        for table in tables:
+            install_change_trigger(conn, table)
+
+        listener, calls = listen(lambda: psycopg2.connect(POSTGRES_DSN), tables)
+        _wait_for(lambda: listener.connected)
+
+        cursor.execute(f"UPDATE {tables[0]} SET value = 1 WHERE id = 1;")
+        conn.commit()
+        _wait_for(lambda: tables[0] in calls)
+
+        # A notification of the other table would arrive meanwhile
+        time.sleep(0.5)
+        assert calls == ['reconnect', tables[0]]
+    finally:
+        conn.rollback()
+        for table in tables:
+            cursor.execute(f"DROP TABLE IF EXISTS {table};")
+        conn.commit()
+        conn.close()
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils.pipeline_functions import Pipeline, filter_positions, zoom_positions
+
+
+def _counting_pipeline(calls):
+    pipeline = Pipeline()
+
+    def double(x):
+        calls.append('double')
+        return x * 2
+
+    def total(doubled, y):
+        calls.append('total')
+        return doubled + y
+
+    pipeline.add_stage('double', double, ['x'])
+    pipeline.add_stage('total', total, ['double', 'y'])
+
+    return pipeline
+
+
+def test_only_stale_stages_are_recomputed():
+    calls = []
+    pipeline = _counting_pipeline(calls)
+
+    assert pipeline.run(['total'], {'x': 1, 'y': 10}) == {'total': 12}
+    assert pipeline.computed == ['double', 'total']
+
+    # Unchanged inputs: everything is memoized
+    assert pipeline.run(['total'], {'x': 1, 'y': 10}) == {'total': 12}
+    assert pipeline.computed == []
+
+    # Only y changed, double is kept
+    assert pipeline.run(['total'], {'x': 1, 'y': 20}) == {'total': 22}
+    assert pipeline.computed == ['total']
+    assert calls == ['double', 'total', 'total']
+
+
+def test_source_keys_replace_unhashable_sources():
+    pipeline = Pipeline()
+    pipeline.add_stage('rows', len, ['frame'])
+    frame = pd.DataFrame({'a': [1, 2]})
+
+    with pytest.raises(ValueError):
+        pipeline.run(['rows'], {'frame': frame})
+
+    assert pipeline.run(['rows'], {'frame': frame}, {'frame': 1}) == {'rows': 2}
+    # Same key: the memoized result is used even though the frame changed
+    assert pipeline.run(['rows'], {'frame': pd.DataFrame({'a': [1]})}, {'frame': 1}) == {'rows': 2}
+    assert pipeline.run(['rows'], {'frame': pd.DataFrame({'a': [1]})}, {'frame': 2}) == {'rows': 1}
+
+
+def test_unknown_and_cyclic_stages_are_rejected():
+    pipeline = Pipeline()
+    pipeline.add_stage('a', lambda b: b, ['b'])
+    pipeline.add_stage('b', lambda a: a, ['a'])
+
+    with pytest.raises(ValueError, match="Cyclic"):
+        pipeline.run(['a'], {})
+    with pytest.raises(ValueError, match="Unknown"):
+        pipeline.run(['c'], {})
+
+
+def test_filter_and_zoom_positions():
+    df = pd.DataFrame({'category': ['Dairy', 'Bakery', 'Dairy', 'Dairy'],
+                       'detailed_category': ['Milk', 'Bread', 'Cheese', 'Milk'],
+                       'emission': [1.0, 0.5, 5.0, 2.0],
+                       'weight_gram': [1000, 500, 250, 500]})
+
+    assert filter_positions(df, None, None).tolist() == [0, 1, 2, 3]
+    positions = filter_positions(df, ('Dairy',), ('Milk', 'Cheese'))
+    assert positions.tolist() == [0, 2, 3]
+
+    assert zoom_positions(df, positions, ((0.0, 2.0), (0.0, 1000.0))).tolist() == [0, 3]
+    assert zoom_positions(df, positions, None) is positions
+    assert len(filter_positions(df, (), None)) == 0
+    assert isinstance(positions, np.ndarray)
@@ -0,0 +1,69 @@
+import json
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+from utils.plot_functions import PatchedFigure, build_selection_patch, rgba_with_alpha, UNSELECTED_ALPHA, \
+    SELECTED_ALPHA
+from utils.pipeline_functions import build_product_pipeline, query_selected_points, apply_selection
+
+
+def _catalog():
+    return pd.DataFrame({'name': ['Milk', 'Bread', 'Cheese', 'Water', 'Butter'],
+                         'category': ['Dairy', 'Bakery', 'Dairy', 'Drinks', 'Dairy'],
+                         'detailed_category': ['Milk', 'Bread', 'Cheese', 'Water', 'Butter'],
+                         'price': [1.5, 3.2, 7.9, 0.9, 2.5],
+                         'emission': [1.2, 0.8, 5.4, 0.1, 9.0],
+                         'weight_gram': [1000, 500, 250, 1500, 250]},
+                        index=[101, 102, 103, 104, 105])
+
+
+def test_patched_json_equals_the_updated_figure():
+    fig = go.Figure(go.Scattergl(x=[1, 2, 3], y=[4, 5, 6], marker={'color': ['red', 'green', 'blue']}))
+    patch = build_selection_patch(np.array([0, 2]))
+
+    patched = json.loads(PatchedFigure(fig.to_json(), patch).to_json())
+    expected = json.loads(fig.update_traces(patch).to_json())
+
+    assert patched == expected
+    assert patched['data'][0]['selectedpoints'] == [0, 2]
+    assert patched['data'][0]['unselected']['marker']['opacity'] == UNSELECTED_ALPHA / SELECTED_ALPHA
+
+
+def test_figures_without_selection_are_not_patched():
+    base_json = go.Figure(go.Scatter(x=[1], y=[2])).to_json()
+
+    assert build_selection_patch(None) is None
+    assert PatchedFigure(base_json).to_json() is base_json
+
+    density_fig = go.Figure()
+    assert apply_selection(density_fig, np.array([0])) is density_fig
+
+
+def test_rgba_with_alpha():
+    assert rgba_with_alpha("rgba(12, 34, 56, 0.8)", 0.2) == "rgba(12, 34, 56, 0.2)"
+
+
+def test_selected_points_are_positions_in_the_view():
+    df = _catalog()
+    positions = np.array([0, 2, 4])
+
+    assert query_selected_points(df, positions, frozenset()) is None
+    assert query_selected_points(df, positions, frozenset({105, 103, 102, 999})).tolist() == [1, 2]
+
+
+def test_selection_change_only_recomputes_the_selection_stages():
+    pipeline = build_product_pipeline()
+    targets = ['product_fig', 'legend_html', 'picker_ids']
+    sources = {'catalog': _catalog(), 'categories': ('Dairy',), 'subcategories': None, 'zoom': None,
+               'selection': frozenset(), 'color_level': 'category', 'filter_level': 'Category'}
+    keys = {'catalog': 1}
+
+    unselected = pipeline.run(targets, sources, keys)
+    assert 'base_fig' in pipeline.computed
+    assert unselected['picker_ids'].tolist() == [101, 103, 105]
+
+    selected = pipeline.run(targets, {**sources, 'selection': frozenset({103})}, keys)
+    assert sorted(pipeline.computed) == ['legend_html', 'picker_ids', 'product_fig', 'selected_points']
+    assert selected['picker_ids'].tolist() == [103]
+    assert selected['product_fig'].base_json is unselected['product_fig'].base_json
+    assert json.loads(selected['product_fig'].to_json())['data'][0]['selectedpoints'] == [1]
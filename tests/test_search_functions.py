@@ -0,0 +1,46 @@
+import pandas as pd
+import pytest
+from utils.search_functions import ProductSearchIndex
+
+
+@pytest.fixture
+def index():
+    products = pd.DataFrame({'name': ['Bio Vollmilch', 'Milchbrot', 'Bergkäse', 'Bio Apfelsaft', 'Apfel'],
+                             'category': ['Dairy', 'Bakery', 'Dairy', 'Drinks', 'Fruits'],
+                             'price': [1.6, 3.2, 7.9, 2.5, 0.9]},
+                            index=[101, 102, 103, 104, 105])
+
+    return ProductSearchIndex(products)
+
+
+def test_words_match_as_substrings_in_label_order(index):
+    product_ids, total = index.search("milch")
+
+    assert product_ids.tolist() == [101, 102]
+    assert total == 2
+
+
+def test_all_query_words_have_to_match(index):
+    product_ids, total = index.search("bio dairy")
+
+    assert product_ids.tolist() == [101]
+    assert total == 1
+
+
+def test_short_words_match_as_prefixes(index):
+    assert index.search("ap")[0].tolist() == [105, 104]
+    assert index.search("xy")[1] == 0
+
+
+def test_pages_and_allowed_ids(index):
+    product_ids, total = index.search("", limit=2, offset=1)
+    assert product_ids.tolist() == [103, 104]
+    assert total == 5
+
+    product_ids, total = index.search("apfel", allowed_ids=[104, 999])
+    assert product_ids.tolist() == [104]
+    assert total == 1
+
+
+def test_label_of_a_product(index):
+    assert index.label(103) == "Bergkäse - Dairy - CHF 7.90"
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils.calc_co2_offset_functions import calc_compensation_days_matrix
+from utils.seasonal_functions import build_seasonal_profile, build_seasonal_offsets, \
+    calc_compensation_days_seasonal, DAYS_PER_YEAR
+
+
+def test_profile_averages_years_and_interpolates_missing_days():
+    dates = pd.to_datetime(['2021-01-01', '2022-01-01', '2021-01-11', '2020-02-29'])
+
+    profile = build_seasonal_profile(dates, [2.0, 4.0, 13.0, 60.0], smoothing_days=0)
+
+    assert len(profile) == DAYS_PER_YEAR
+    assert profile[0] == 3.0
+    assert profile[10] == 13.0
+    assert profile[5] == pytest.approx(8.0)
+    # Feb 29 counts as Mar 1
+    assert profile[59] == 60.0
+
+
+def test_profile_without_values_is_rejected():
+    with pytest.raises(ValueError):
+        build_seasonal_profile(pd.to_datetime(['2021-01-01']), [np.nan])
+
+
+def test_constant_profiles_give_the_days_of_constant_weather():
+    emissions = pd.Series([0.5, 12.0, 40.0], index=['a', 'b', 'c'])
+    offsets = build_seasonal_offsets(np.full(DAYS_PER_YEAR, 6.0), np.full(DAYS_PER_YEAR, 120.0), start_day=100)
+
+    seasonal = calc_compensation_days_seasonal(emissions, offsets)
+    constant = calc_compensation_days_matrix(emissions, sun_hours=6.0, flow_rate=120.0)
+
+    assert list(seasonal.index) == ['a', 'b', 'c']
+    np.testing.assert_allclose(seasonal.to_numpy(), constant.to_numpy())
+
+
+def test_seasons_change_the_days_and_methods_without_offset_never_finish():
+    # Sun only in the first half of the year
+    sun_hours = np.where(np.arange(DAYS_PER_YEAR) < 182, 8.0, 0.0)
+    flow_rates = np.zeros(DAYS_PER_YEAR)
+
+    in_summer = calc_compensation_days_seasonal([1.0], build_seasonal_offsets(sun_hours, flow_rates, start_day=0))
+    in_winter = calc_compensation_days_seasonal([1.0], build_seasonal_offsets(sun_hours, flow_rates, start_day=200))
+
+    assert in_winter.loc[0, 'solar'] > in_summer.loc[0, 'solar'] + 100
+    assert in_summer.loc[0, 'trees'] == pytest.approx(in_winter.loc[0, 'trees'])
+    assert np.isinf(in_summer.loc[0, 'hydro'])
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils.stats_functions import build_category_emission_index, get_emission_window, build_stats_index, \
+    calc_percentile_rank, calc_percentile_ranks
+
+
+def _products():
+    return pd.DataFrame({'category': ['Dairy', 'Bakery', 'Dairy', 'Dairy', 'Bakery', 'Dairy'],
+                         'emission': [5.4, 0.8, 1.2, 1.2, 0.3, 9.0]},
+                        index=[10, 11, 12, 13, 14, 15])
+
+
+def test_category_emission_index_sorts_every_category_by_emission():
+    index = build_category_emission_index(_products())
+
+    emissions, product_ids = index['Dairy']
+    assert emissions.tolist() == [1.2, 1.2, 5.4, 9.0]
+    assert product_ids.tolist() == [12, 13, 10, 15]
+    assert index['Bakery'][1].tolist() == [14, 11]
+
+
+def test_emission_window_is_centered_on_the_product():
+    emissions = np.arange(100, dtype=np.float64)
+    product_ids = np.arange(1000, 1100)
+
+    window = get_emission_window(emissions, product_ids, 1050, 50.0, k=10)
+
+    assert window.tolist() == list(range(1045, 1055))
+
+
+def test_emission_window_stays_within_the_category():
+    emissions, product_ids = build_category_emission_index(_products())['Dairy']
+
+    assert get_emission_window(emissions, product_ids, 12, 1.2, k=3).tolist() == [12, 13, 10]
+    assert get_emission_window(emissions, product_ids, 15, 9.0, k=3).tolist() == [13, 10, 15]
+    assert get_emission_window(emissions, product_ids, 13, 1.2, k=10).tolist() == [12, 13, 10, 15]
+
+
+def test_stats_index_of_all_products_and_categories():
+    stats_index = build_stats_index(_products(), levels=('category',))
+
+    assert stats_index['all'].count == 6
+    assert stats_index['all'].min == 0.3
+    assert stats_index['all'].max == 9.0
+
+    dairy = stats_index['category']['Dairy']
+    assert dairy.count == 4
+    assert dairy.mean == pytest.approx(4.2)
+    assert dairy.product_ids.tolist() == [12, 13, 10, 15]
+
+
+def test_percentile_rank_counts_products_with_lower_emission():
+    dairy = build_stats_index(_products(), levels=('category',))['category']['Dairy']
+
+    assert calc_percentile_rank(dairy, 1.2) == 0.0
+    assert calc_percentile_rank(dairy, 5.4) == 50.0
+    assert calc_percentile_rank(dairy, 100.0) == 100.0
+
+
+def test_percentile_ranks_match_single_ranks_and_skip_unknown_categories():
+    category_stats = build_stats_index(_products(), levels=('category',))['category']
+    categories = ['Dairy', 'Bakery', 'Drinks', 'Dairy']
+    emissions = [5.4, 0.8, 1.0, 0.1]
+
+    ranks, means = calc_percentile_ranks(category_stats, categories, emissions)
+
+    for category, emission, rank, mean in zip(categories, emissions, ranks, means):
+        if category == 'Drinks':
+            assert np.isnan(rank) and np.isnan(mean)
+        else:
+            assert rank == calc_percentile_rank(category_stats[category], emission)
+            assert mean == category_stats[category].mean
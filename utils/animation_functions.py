@@ -0,0 +1,49 @@
+import numpy as np
+from typing import Sequence, Tuple
+
+# Frame budget of the compensation animation
+MAX_UPDATES_PER_SECOND = 10
+MAX_FRAMES = 150
+
+
+def plan_animation_frames(max_t: float, time_waiting: float,
+                          max_updates_per_second: float = MAX_UPDATES_PER_SECOND,
+                          max_frames: int = MAX_FRAMES) -> Tuple[np.ndarray, float]:
+    """
+    Plans the frames of an animation that runs from day 0 to day max_t.
+
+    The animation takes as long as advancing one day every time_waiting seconds would,
+    but uses at most max_updates_per_second frames per second and max_frames frames.
+
+    Returns:
+        Simulated day of every frame (the last frame is max_t) and the seconds between frames.
+    """
+    duration = max_t * time_waiting
+    num_frames = int(min(max_frames, max(duration * max_updates_per_second, 1), max(np.ceil(max_t), 1)))
+
+    frame_days = np.linspace(0, max_t, num_frames + 1)[1:]
+
+    return frame_days, duration / num_frames
+
+
+def calc_frame_percentages(frame_days: np.ndarray, t_compensations: Sequence[float]) -> np.ndarray:
+    """
+    Calculates the progress in percent of every compensation method for every frame in closed form.
+
+    Returns:
+        np.ndarray of shape (frames, methods) with integer percentages capped at 100.
+        Methods that never offset (np.inf days) stay at 0.
+    """
+    t = np.asarray(t_compensations, dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentages = np.round(frame_days[:, np.newaxis] / t[np.newaxis, :] * 100)
+
+    return np.clip(np.nan_to_num(percentages), 0, 100).astype(int)
+
+
+def format_days(days: float) -> str:
+    """
+    Formats days as months (of 30 days) and days.
+    """
+    return f"{int(days // 30)} months {round(days % 30)} days"
@@ -0,0 +1,162 @@
+import io
+import os
+import glob
+import hashlib
+import logging
+import threading
+import urllib.request
+from typing import Callable, Dict, List, NamedTuple, Optional
+from PIL import Image, ImageOps
+from utils.helper_functions import read_markdown
+
+logger = logging.getLogger(__name__)
+
+# Widths the images are pre-resized to, images are never upscaled
+IMAGE_WIDTHS = (480, 960, 1440)
+IMAGE_FORMAT = 'webp'
+IMAGE_QUALITY = 80
+
+# Served by Streamlit's static file serving (server.enableStaticServing) under STATIC_URL.
+# URLs carry a content hash (?v=), for which the files are served with long-lived cache headers.
+STATIC_DIR = 'static'
+STATIC_URL = 'app/static'
+
+# Sources of the weather backgrounds, downloaded once and served locally afterwards
+WEATHER_BACKGROUND_URLS = {
+    'rain': "https://images.unsplash.com/photo-1620385019253-b051a26048ce?ixlib=rb-4.0.3&ixid"
+            "=MnwxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8&auto=format&fit=crop&w=687&q=80",
+    'sun': "https://images.unsplash.com/photo-1559628376-f3fe5f782a2e?ixlib=rb-4.0.3&ixid"
+           "=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D&auto=format&fit=crop&w=862&q=80",
+    'covered': "https://images.unsplash.com/photo-1500740516770-92bd004b996e?ixlib=rb-4.0.3&ixid"
+               "=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D&auto=format&fit=crop&w=1472&q=80",
+    'snow': "https://images.unsplash.com/photo-1511131341194-24e2eeeebb09?ixlib=rb-4.0.3&ixid"
+            "=MnwxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8&auto=format&fit=crop&w=1470&q=80",
+}
+
+
+class ImageVariant(NamedTuple):
+    """
+    Resized version of an image, url includes the content hash for caching.
+    """
+    width: int
+    path: str
+    url: str
+
+
+class AssetBundle:
+    """
+    Texts and images of the app, prepared once per process.
+
+    The markdown texts of asset_dir are held in memory. The images of image_dir are
+    resized to IMAGE_WIDTHS and stored as WebP in static_dir, existing variants
+    newer than their source are reused. Weather backgrounds are downloaded in the
+    background by load_backgrounds_async(), until then callers fall back to the remote URL.
+    """
+
+    def __init__(self, asset_dir: str = 'assets', image_dir: str = 'images',
+                 static_dir: str = STATIC_DIR, widths=IMAGE_WIDTHS):
+        self.static_dir = static_dir
+        self.widths = tuple(sorted(widths))
+
+        self.texts: Dict[str, str] = {os.path.basename(path): read_markdown(path)
+                                      for path in sorted(glob.glob(os.path.join(asset_dir, '*.md')))}
+
+        self.images: Dict[str, List[ImageVariant]] = {}
+        for path in sorted(glob.glob(os.path.join(image_dir, '*'))):
+            if os.path.isfile(path):
+                name = os.path.splitext(os.path.basename(path))[0]
+                self.images[name] = self._build_variants('images', name, lambda path=path: Image.open(path),
+                                                         os.path.getmtime(path))
+
+        # Backgrounds downloaded by a previous run are served right away
+        self.backgrounds: Dict[str, List[ImageVariant]] = {}
+        for condition in WEATHER_BACKGROUND_URLS:
+            variants = self._existing_variants('backgrounds', condition)
+            if variants:
+                self.backgrounds[condition] = variants
+
+        self._background_thread: Optional[threading.Thread] = None
+
+    def text(self, name: str) -> str:
+        return self.texts[name]
+
+    def image(self, name: str, width: int) -> ImageVariant:
+        """
+        Returns the smallest variant of the image at least width wide, the largest if none is.
+        """
+        variants = self.images[name]
+        return next((variant for variant in variants if variant.width >= width), variants[-1])
+
+    def srcset(self, name: str) -> str:
+        return ", ".join(f"{variant.url} {variant.width}w" for variant in self.images[name])
+
+    def background_variants(self, condition: str) -> List[ImageVariant]:
+        """
+        Local variants of the weather background, empty until it is downloaded.
+        """
+        return self.backgrounds.get(condition, [])
+
+    def load_backgrounds_async(self, urls: Dict[str, str] = WEATHER_BACKGROUND_URLS):
+        """
+        Downloads and resizes the missing weather backgrounds in a daemon thread.
+        """
+        missing = {condition: url for condition, url in urls.items() if condition not in self.backgrounds}
+        if not missing or self._background_thread is not None:
+            return
+
+        def load():
+            for condition, url in missing.items():
+                try:
+                    with urllib.request.urlopen(url, timeout=10) as response:
+                        data = response.read()
+                    self.backgrounds[condition] = self._build_variants(
+                        'backgrounds', condition, lambda: Image.open(io.BytesIO(data)), None)
+                except Exception:
+                    logger.warning("Download of %s background failed", condition, exc_info=True)
+
+        self._background_thread = threading.Thread(target=load, daemon=True)
+        self._background_thread.start()
+
+    def _variant_path(self, group: str, name: str, width) -> str:
+        return os.path.join(self.static_dir, group, f"{name}_{width}.{IMAGE_FORMAT}")
+
+    def _variant(self, group: str, name: str, width: int) -> ImageVariant:
+        path = self._variant_path(group, name, width)
+        with open(path, 'rb') as f:
+            version = hashlib.sha1(f.read()).hexdigest()[:12]
+
+        return ImageVariant(width, path, f"{STATIC_URL}/{group}/{name}_{width}.{IMAGE_FORMAT}?v={version}")
+
+    def _existing_variants(self, group: str, name: str) -> List[ImageVariant]:
+        widths = []
+        for path in glob.glob(self._variant_path(group, name, '*')):
+            width = os.path.basename(path)[len(name) + 1:-len(IMAGE_FORMAT) - 1]
+            if width.isdigit():
+                widths.append(int(width))
+
+        return [self._variant(group, name, width) for width in sorted(widths)]
+
+    def _build_variants(self, group: str, name: str, open_image: Callable[[], Image.Image],
+                        source_mtime: Optional[float]) -> List[ImageVariant]:
+        existing = self._existing_variants(group, name)
+        if existing and source_mtime is not None and \
+                all(os.path.getmtime(variant.path) >= source_mtime for variant in existing):
+            return existing
+
+        os.makedirs(os.path.join(self.static_dir, group), exist_ok=True)
+
+        with open_image() as source:
+            # JPEGs are decoded at the smallest scale that still covers the largest width
+            source.draft('RGB', (max(self.widths), 1))
+            image = ImageOps.exif_transpose(source).convert('RGB')
+
+        # Widths above the source width collapse to one variant in the source width
+        widths = sorted({min(width, image.width) for width in self.widths})
+        for width in widths:
+            resized = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+            path = self._variant_path(group, name, width)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            resized.save(tmp_path, format=IMAGE_FORMAT, quality=IMAGE_QUALITY)
+            os.replace(tmp_path, path)
+
+        return [self._variant(group, name, width) for width in widths]
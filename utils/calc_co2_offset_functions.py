@@ -1,5 +1,64 @@
+import numpy as np
+import pandas as pd
+from typing import Tuple, Union
+
+ArrayLike = Union[float, np.ndarray, pd.Series, list]
+
+# Swiss CO2 emission per kWh (see docstrings below for the derivation)
+CH_EMISSION_KWH = 0.11237383
+
+SOLAR_PANEL_POWER = 385
+SOLAR_PERFORMANCE_RATIO = 0.21  # losses due to shading, dirt, dust and other environmental conditions
+
+TREE_OFFSET_DAILY = 0.02739726
+
+HYDRO_NET_HEAD = 1
+HYDRO_WATER_ACCELERATION = 9.81
+HYDRO_PERFORMANCE_RATIO = 0.21  # Same as solar panel as information can not be estimated
+AARE_WIDTH = 40
+
+OFFSET_DECIMALS = 5
+
+
+def _round_offsets(offsets: np.ndarray) -> np.ndarray:
+    """
+    Rounds offsets to OFFSET_DECIMALS like round() in the scalar functions.
+
+    np.round scales by 10 ** OFFSET_DECIMALS, which rounds some values just below a half up,
+    the few offsets close to a half are therefore rounded one by one with round().
+    """
+    # Kept as array for zero-dimensional offsets of a single value
+    rounded = np.array(np.round(offsets, OFFSET_DECIMALS))
+    scaled = offsets * 10 ** OFFSET_DECIMALS
+    near_half = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if near_half.any():
+        rounded[near_half] = [round(offset, OFFSET_DECIMALS) for offset in offsets[near_half].tolist()]
+
+    return rounded[()]
+
 
 # SOLAR
+def _solar_energy_offset(avg_sun_duration_hours):
+    """
+    Unrounded solar offset formula, works on scalars and np.ndarrays alike.
+    """
+    solar_power = avg_sun_duration_hours * SOLAR_PANEL_POWER * SOLAR_PERFORMANCE_RATIO / 1000
+
+    return solar_power * CH_EMISSION_KWH
+
+
+def calc_solar_energy_offset_batch(avg_sun_duration_hours: ArrayLike) -> np.ndarray:
+    """
+    Vectorized version of calc_solar_energy_offset.
+
+    Takes an array or pd.Series of sun hours and returns
+    the CO2 offset per day in CO2/KG for every entry as np.ndarray.
+    """
+    sun_hours = np.asarray(avg_sun_duration_hours, dtype=np.float64)
+
+    return _round_offsets(_solar_energy_offset(sun_hours))
+
+
 def calc_solar_energy_offset(avg_sun_duration_hours: float) -> float:
     """
     Calculates co2 emission offset for a solar panel per day based on Swiss energy mix
@@ -29,18 +88,29 @@ def calc_solar_energy_offset(avg_sun_duration_hours: float) -> float:
     Returns:
         CO2 offset per day in CO2/KG
     """
-    CH_EMISSION_KWH = 0.11237383
-    SOLAR_PANEL_POWER = 385
-    PERFORMANCE_RATIO = 0.21  # losses due to shading, dirt, dust and other environmental conditions
+    return round(_solar_energy_offset(avg_sun_duration_hours), OFFSET_DECIMALS)
 
-    solar_power = avg_sun_duration_hours * SOLAR_PANEL_POWER * PERFORMANCE_RATIO / 1000
 
-    offset_solar_power = round(solar_power * CH_EMISSION_KWH, 5)
+# TREES
+def _trees_offset(num_trees):
+    """
+    Unrounded tree offset formula, works on scalars and np.ndarrays alike.
+    """
+    return num_trees * TREE_OFFSET_DAILY
 
-    return offset_solar_power
+
+def calc_trees_offset_batch(num_trees: ArrayLike) -> np.ndarray:
+    """
+    Vectorized version of calc_trees_offset.
+
+    Takes an array or pd.Series of tree counts and returns
+    the CO2 offset per day in CO2/KG for every entry as np.ndarray.
+    """
+    trees = np.asarray(num_trees, dtype=np.float64)
+
+    return _round_offsets(_trees_offset(trees))
 
 
-# TREES
 def calc_trees_offset(num_trees: int) -> float:
     """
     Calculates the co2 emission that is offset by a given number (num_trees) of trees.
@@ -52,14 +122,39 @@ def calc_trees_offset(num_trees: int) -> float:
     Returns:
         CO2 offset per day in CO2/KG
     """
-    TREE_OFFSET_DAILY = 0.02739726
+    return round(_trees_offset(num_trees), OFFSET_DECIMALS)
 
-    offset_tree = round(num_trees * TREE_OFFSET_DAILY, 5)
 
-    return offset_tree
+# HYDRO
+def _hydro_offset(flow_rate):
+    """
+    Unrounded hydro offset formula, works on scalars and np.ndarrays alike.
+    """
+    effective_flow_rate_waterwheel = flow_rate / AARE_WIDTH
+
+    # Calculate hydro power in watts
+    hydro_power = HYDRO_NET_HEAD * effective_flow_rate_waterwheel * HYDRO_WATER_ACCELERATION
+
+    # Adjust hydro power based on efficiency rating
+    adjusted_hydro_power = hydro_power * HYDRO_PERFORMANCE_RATIO
+
+    hydro_kwh_day = adjusted_hydro_power * 24 / 1000
+
+    return hydro_kwh_day * CH_EMISSION_KWH
+
+
+def calc_hydro_offset_batch(flow_rate: ArrayLike) -> np.ndarray:
+    """
+    Vectorized version of calc_hydro_offset.
+
+    Takes an array or pd.Series of Aare flow rates in m3/s and returns
+    the CO2 offset per day in CO2/KG for every entry as np.ndarray.
+    """
+    flow = np.asarray(flow_rate, dtype=np.float64)
+
+    return _round_offsets(_hydro_offset(flow))
 
 
-# HYDRO
 def calc_hydro_offset(flow_rate: float) -> float:
     """
     Calculates the daily co2 emission that is offset by a water wheel with a
@@ -91,34 +186,69 @@ def calc_hydro_offset(flow_rate: float) -> float:
 
 
     Returns:
-        Hydro power in watts.
+        CO2 offset per day in CO2/KG
     """
-    NET_HEAD = 1
-    WATER_ACCELERATION = 9.81
-    PERFORMANCE_RATIO = 0.21 # Same as solar panel as information can not be estimated
-    CH_EMISSION_KWH = 0.11237383
+    return round(_hydro_offset(flow_rate), OFFSET_DECIMALS)
 
-    effective_flow_rate_waterwheel = flow_rate / 40
 
-    # Calculate hydro power in watts
-    hydro_power = NET_HEAD * effective_flow_rate_waterwheel * WATER_ACCELERATION
+# COMPENSATION TIME
+COMPENSATION_METHODS = ['trees', 'solar', 'hydro']
 
-    # Adjust hydro power based on efficiency rating
-    adjusted_hydro_power = hydro_power * PERFORMANCE_RATIO
 
-    hydro_kwh_day = adjusted_hydro_power * 24 / 1000
+def calc_compensation_days_matrix(emission: ArrayLike, sun_hours: float, flow_rate: float,
+                                  num_trees: int = 1) -> pd.DataFrame:
+    """
+    Calculates the days needed per compensation method to offset every emission in CO2/KG.
 
-    offset_hydro_power = round(hydro_kwh_day * CH_EMISSION_KWH, 5)
+    The daily offsets are computed once for the given weather snapshot (sun_hours, flow_rate)
+    and broadcast over all emissions. If emission is a pd.Series its index is kept, so the
+    row of a product can be looked up by its index label.
 
-    return offset_hydro_power
+    Returns:
+        pd.DataFrame with one row per emission and one column per compensation method.
+        Methods without any offset under the current conditions have np.inf days.
+    """
+    index = emission.index if isinstance(emission, pd.Series) else None
+    emissions = np.asarray(emission, dtype=np.float64)
 
+    daily_offsets = np.array([calc_trees_offset(num_trees),
+                              calc_solar_energy_offset(sun_hours),
+                              calc_hydro_offset(flow_rate)], dtype=np.float64)
 
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days = emissions[:, np.newaxis] / daily_offsets[np.newaxis, :]
 
+    return pd.DataFrame(days, index=index, columns=COMPENSATION_METHODS)
 
 
+def calc_basket_compensation(emission: ArrayLike, quantity: ArrayLike, sun_hours: float, flow_rate: float,
+                             num_trees: int = 1) -> Tuple[pd.DataFrame, pd.Series]:
+    """
+    Calculates the emission and compensation days of a basket of products in one vectorized pass.
 
+    emission holds the emission of one unit per item, quantity the number of units. If emission
+    is a pd.Series its index is kept for the items.
+
+    Returns:
+        pd.DataFrame with one row per item: total emission of the item, its share of the basket
+        emission and the days per compensation method to offset the item.
+        pd.Series with the emission and the days per compensation method of the whole basket.
+    """
+    index = emission.index if isinstance(emission, pd.Series) else None
+    item_emissions = np.asarray(emission, dtype=np.float64) * np.asarray(quantity, dtype=np.float64)
+    total_emission = item_emissions.sum()
 
+    # Days are linear in the emission, so item and basket days share the daily offsets
+    days = calc_compensation_days_matrix(np.append(item_emissions, total_emission), sun_hours, flow_rate,
+                                         num_trees).to_numpy()
 
+    shares = item_emissions / total_emission if total_emission > 0 else np.zeros_like(item_emissions)
 
+    items = pd.DataFrame(days[:-1], index=index, columns=COMPENSATION_METHODS)
+    items.insert(0, 'emission', item_emissions)
+    items.insert(1, 'share', shares)
 
+    totals = pd.Series(days[-1], index=COMPENSATION_METHODS)
+    totals['emission'] = total_emission
 
+    return items, totals
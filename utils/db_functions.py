@@ -0,0 +1,447 @@
+import sys
+import time
+import threading
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+
+def get_placeholder(conn) -> str:
+    """
+    Returns the query parameter placeholder of the DB-API driver behind conn
+    ('%s' for psycopg2, '?' for sqlite3).
+    """
+    driver = sys.modules[type(conn).__module__.split('.')[0]]
+    return '?' if getattr(driver, 'paramstyle', 'pyformat') == 'qmark' else '%s'
+
+
+def to_db_value(value: Any) -> Any:
+    """
+    Converts pandas/numpy scalars into plain Python values the DB drivers can adapt.
+    """
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+# Product columns stored as categoricals
+CATEGORICAL_COLUMNS = ('category', 'detailed_category')
+
+# Float columns that keep float64, they are shown and calculated with
+FLOAT64_COLUMNS = ('emission', 'price', 'compensation_price')
+
+# Product columns the app and the API use, the catalog is synced with only these columns
+# (plus the key and watermark column of ProductDataSync)
+PRODUCT_COLUMNS = ('id', 'name', 'category', 'detailed_category', 'price', 'compensation_price', 'emission',
+                   'weight_gram')
+
+# Symbols removed from product names, they might disrupt the filtering dropdown
+NAME_SYMBOLS_PATTERN = r"[-/\\]"
+
+
+def compact_product_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Prepares product data at ingest: names are cleaned once, category columns become
+    categoricals, integer columns are downcast and float columns holding only integral
+    values that float32 represents exactly are stored as float32.
+    The columns of FLOAT64_COLUMNS and float columns with fractional values keep float64.
+    """
+    columns = {}
+
+    if 'name' in df.columns:
+        columns['name'] = df['name'].str.replace(NAME_SYMBOLS_PATTERN, "", regex=True)
+
+    for column in CATEGORICAL_COLUMNS:
+        if column in df.columns:
+            columns[column] = df[column].astype('category')
+
+    for column in df.columns:
+        if column in columns or column in FLOAT64_COLUMNS or pd.api.types.is_bool_dtype(df[column]):
+            continue
+        values = df[column]
+        if pd.api.types.is_integer_dtype(values):
+            columns[column] = pd.to_numeric(values, downcast='integer')
+        elif pd.api.types.is_float_dtype(values):
+            finite = values[np.isfinite(values)]
+            if len(finite) and (finite == np.round(finite)).all() and finite.abs().max() < 2 ** 24:
+                columns[column] = values.astype(np.float32)
+
+    return df.assign(**columns)
+
+
+def union_categories(df: pd.DataFrame, other: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Gives the categorical columns of both frames the same categories, so rows can be
+    combined without falling back to object columns.
+    """
+    columns, other_columns = {}, {}
+    for column in CATEGORICAL_COLUMNS:
+        if column in df.columns and column in other.columns:
+            categories = df[column].cat.categories.union(other[column].cat.categories)
+            columns[column] = df[column].cat.set_categories(categories)
+            other_columns[column] = other[column].cat.set_categories(categories)
+
+    return df.assign(**columns), other.assign(**other_columns)
+
+
+# Views holding the last available data of live tables that are not extracted anymore
+LIVE_TABLE_FALLBACKS = {'current_weather': 'last_weather_data', 'sun_hours': 'last_sun_hours_data'}
+
+# Marks the rows of the fallback view in the combined live table query
+FALLBACK_COLUMN = 'is_fallback'
+
+
+def _has_current_data(table: str, df: pd.DataFrame) -> bool:
+    # Weather and sun hours are not extracted anymore if there is no data for today
+    if df.empty:
+        return False
+    if table == 'sun_hours':
+        return not pd.isna(df['sum'].iloc[0])
+    return True
+
+
+def load_live_table(pool: 'ConnectionPool', table: str) -> pd.DataFrame:
+    """
+    Loads a live table (current weather, sun hours, hydro data) and falls back
+    to the last available data if there is no current data anymore.
+
+    Tables with a fallback view are fetched together with the view in one round trip,
+    the view has to have the same columns as the table. If it does not, the table
+    and the view are queried one after the other.
+    """
+    fallback = LIVE_TABLE_FALLBACKS.get(table)
+
+    with pool.connection() as conn:
+        if fallback is None:
+            return pd.read_sql_query(f"SELECT * FROM {table};", conn)
+
+        try:
+            df = pd.read_sql_query(f"SELECT *, 0 AS {FALLBACK_COLUMN} FROM {table} "
+                                   f"UNION ALL SELECT *, 1 AS {FALLBACK_COLUMN} FROM {fallback};", conn)
+        except Exception:
+            _rollback(conn)
+            df = pd.read_sql_query(f"SELECT * FROM {table};", conn)
+            if not _has_current_data(table, df):
+                df = pd.read_sql_query(f"SELECT * FROM {fallback};", conn)
+            return df
+
+    is_fallback = df.pop(FALLBACK_COLUMN).to_numpy() == 1
+    current = df[~is_fallback]
+
+    return (current if _has_current_data(table, current) else df[is_fallback]).reset_index(drop=True)
+
+
+def load_live_tables(pool: 'ConnectionPool', tables: Sequence[str]) -> Dict[str, pd.DataFrame]:
+    """
+    Loads several live tables concurrently on connections of pool, so loading
+    takes as long as the slowest table instead of all tables together.
+    """
+    if not tables:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=min(len(tables), pool.max_size)) as executor:
+        futures = {table: executor.submit(load_live_table, pool, table) for table in tables}
+        return {table: future.result() for table, future in futures.items()}
+
+
+class ConnectionPool:
+    """
+    Bounded pool of DB-API connections created by connect_func.
+
+    Connections are checked out with the connection() context manager. A checked out
+    connection that was idle for longer than health_check_interval seconds is pinged
+    with SELECT 1 first and transparently replaced if it is dead. If all max_size
+    connections are in use the caller waits up to timeout seconds for a free one.
+    """
+
+    def __init__(self, connect_func: Callable[[], Any], max_size: int = 10,
+                 timeout: float = 30, health_check_interval: float = 30):
+        self.connect_func = connect_func
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._idle: List[Tuple[Any, float]] = []
+        self._size = 0
+        self._condition = threading.Condition()
+        self._stats = {'checkouts': 0, 'waits': 0, 'wait_time_total': 0.0, 'wait_time_max': 0.0,
+                       'reconnects': 0, 'failed_health_checks': 0, 'discarded': 0}
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a healthy connection and returns it to the pool afterwards.
+        Connections that raised an error and can not be rolled back are discarded.
+        """
+        conn = self._checkout()
+        try:
+            yield conn
+        except Exception:
+            self._release(conn, healthy=_rollback(conn))
+            raise
+        else:
+            self._release(conn, healthy=_rollback(conn))
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Returns pool usage metrics to size the pool for peak concurrency.
+        """
+        with self._condition:
+            in_use = self._size - len(self._idle)
+            return {'max_size': self.max_size, 'size': self._size, 'in_use': in_use,
+                    'idle': len(self._idle), **self._stats}
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        with self._condition:
+            for conn, _ in self._idle:
+                _close(conn)
+            self._size -= len(self._idle)
+            self._idle.clear()
+            self._condition.notify_all()
+
+    def _checkout(self):
+        start = time.monotonic()
+        waited = False
+
+        with self._condition:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+
+                waited = True
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    raise TimeoutError(f"No database connection available after {self.timeout} s")
+
+            wait_time = time.monotonic() - start
+            self._stats['checkouts'] += 1
+            if waited:
+                self._stats['waits'] += 1
+                self._stats['wait_time_total'] += wait_time
+                self._stats['wait_time_max'] = max(self._stats['wait_time_max'], wait_time)
+
+        try:
+            if conn is None:
+                return self.connect_func()
+
+            if time.monotonic() - last_used > self.health_check_interval and not _is_alive(conn):
+                _close(conn)
+                with self._condition:
+                    self._stats['failed_health_checks'] += 1
+                    self._stats['reconnects'] += 1
+                return self.connect_func()
+
+            return conn
+        except Exception:
+            # Free the slot if no connection could be created
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, conn, healthy: bool):
+        with self._condition:
+            if healthy:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                _close(conn)
+                self._size -= 1
+                self._stats['discarded'] += 1
+            self._condition.notify()
+
+
+def _is_alive(conn) -> bool:
+    if getattr(conn, 'closed', 0):
+        return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1;")
+        cursor.fetchone()
+        cursor.close()
+        return _rollback(conn)
+    except Exception:
+        return False
+
+
+def _rollback(conn) -> bool:
+    # Ends the open transaction so idle connections do not hold locks or snapshots
+    try:
+        conn.rollback()
+        return not getattr(conn, 'closed', 0)
+    except Exception:
+        return False
+
+
+def _close(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class ProductDataSync:
+    """
+    Keeps the product data frame loaded and only fetches rows changed since the last sync.
+
+    The first sync loads the full table. Later syncs fetch rows whose watermark_column
+    (an updated-at timestamp or an increasing primary key) is bigger than the highest
+    value seen so far and merge them into the loaded frame by key_column.
+    Rows that no longer match the emission filter are dropped. If the table has no
+    watermark or key column every sync falls back to a full reload.
+
+    Only the given columns (default PRODUCT_COLUMNS) that exist in the table are selected.
+    The category and subcategory filters are not pushed down into the queries per rerun,
+    the catalog is held once in memory and filtered there by positions, so a filter
+    change costs no database round trip.
+
+    version is increased whenever the frame changes and can be used as a cache key
+    for results derived from the frame. The frame is prepared by compact_product_frame
+    and never modified, syncs replace it, so it can be shared read-only by all sessions.
+    """
+
+    def __init__(self, table: str = 'product_data', key_column: str = 'id',
+                 watermark_column: str = 'updated_at', min_interval: float = 300,
+                 columns: Sequence[str] = PRODUCT_COLUMNS):
+        for identifier in (table, key_column, watermark_column, *columns):
+            if not identifier.isidentifier():
+                raise ValueError(f"Invalid column or table name: {identifier}")
+
+        self.table = table
+        self.columns = tuple(columns)
+        self.key_column = key_column
+        self.watermark_column = watermark_column
+        self.min_interval = min_interval
+
+        self.frame: Optional[pd.DataFrame] = None
+        self.watermark = None
+        self.version = 0
+        self.last_sync = 0.0
+        self._lock = threading.Lock()
+        self._shared: Tuple[Optional[pd.DataFrame], int] = (None, 0)
+        self._select: Optional[str] = None
+
+    def refresh(self, pool: ConnectionPool, force: bool = False) -> pd.DataFrame:
+        """
+        Syncs the frame with the database if min_interval seconds have passed
+        since the last sync (or force is set) and returns the frame.
+        A connection is only checked out of the pool if a sync is due.
+        """
+        with self._lock:
+            if self.frame is None:
+                with pool.connection() as conn:
+                    self._full_load(conn)
+            elif force or time.monotonic() - self.last_sync >= self.min_interval:
+                with pool.connection() as conn:
+                    if self._supports_delta():
+                        self._delta_load(conn)
+                    else:
+                        self._full_load(conn)
+
+            return self.frame
+
+    def seed(self, df: pd.DataFrame):
+        """
+        Uses df (e.g. a local snapshot) as loaded frame, so the next sync
+        only fetches rows changed since the snapshot was taken.
+        """
+        with self._lock:
+            self._set_frame(df)
+            # The snapshot may be outdated, so the next sync is due right away
+            self.last_sync = 0.0
+
+    def shared(self) -> Tuple[Optional[pd.DataFrame], int]:
+        """
+        Returns the frame and its version without copying or waiting for a running sync.
+        The frame is shared and must not be modified.
+        """
+        return self._shared
+
+    def copy(self) -> Optional[pd.DataFrame]:
+        """
+        Returns a copy of the frame that is safe to modify while syncs run.
+        """
+        with self._lock:
+            return None if self.frame is None else self.frame.copy()
+
+    def _supports_delta(self) -> bool:
+        return self.key_column in self.frame.columns and self.watermark_column in self.frame.columns
+
+    def _select_list(self, conn) -> str:
+        """
+        Columns to select, the wanted columns the table has. Looked up once without fetching rows.
+        """
+        if self._select is None:
+            available = pd.read_sql_query(f"SELECT * FROM {self.table} WHERE 1 = 0;", conn).columns
+            wanted = dict.fromkeys((*self.columns, self.key_column, self.watermark_column))
+            self._select = ', '.join(column for column in wanted if column in available)
+
+        return self._select
+
+    def _full_load(self, conn):
+        df = pd.read_sql_query(f"SELECT {self._select_list(conn)} FROM {self.table} WHERE emission != 0;", conn)
+        self._set_frame(df)
+
+    def _set_frame(self, df: pd.DataFrame):
+        df = compact_product_frame(df)
+        if self.key_column in df.columns:
+            df = df.set_index(self.key_column, drop=False)
+            df.index.name = None
+
+        self.frame = df
+        self.watermark = df[self.watermark_column].max() if self.watermark_column in df.columns else None
+        self.version += 1
+        self.last_sync = time.monotonic()
+        self._shared = (self.frame, self.version)
+
+    def _delta_load(self, conn):
+        if self.watermark is None or pd.isna(self.watermark):
+            self._full_load(conn)
+            return
+
+        query = f"SELECT {self._select_list(conn)} FROM {self.table} " \
+                f"WHERE {self.watermark_column} > {get_placeholder(conn)};"
+        delta = pd.read_sql_query(query, conn, params=(to_db_value(self.watermark),))
+        self.last_sync = time.monotonic()
+
+        if delta.empty:
+            return
+
+        delta = compact_product_frame(delta).set_index(self.key_column, drop=False)
+        delta.index.name = None
+        delta = delta[~delta.index.duplicated(keep='last')]
+
+        # The shared frame is not modified, the changes are applied to a new frame
+        frame, delta = union_categories(self.frame, delta)
+
+        watermark = delta[self.watermark_column].max()
+
+        # Rows whose emission changed to 0 leave the catalog
+        removed = delta.index[delta['emission'] == 0]
+        delta = delta[delta['emission'] != 0]
+        frame = frame.drop(index=frame.index.intersection(removed))
+
+        # Update existing rows and append new ones
+        existing = delta.index.intersection(frame.index)
+        columns = frame.columns.intersection(delta.columns)
+        frame.loc[existing, columns] = delta.loc[existing, columns]
+
+        new_rows = delta.index.difference(frame.index)
+        if len(new_rows):
+            frame = pd.concat([frame, delta.loc[new_rows, frame.columns]])
+
+        self.frame = frame
+        self.watermark = max(self.watermark, watermark)
+        self.version += 1
+        self._shared = (self.frame, self.version)
@@ -1,4 +1,5 @@
 import streamlit as st
+from utils.asset_functions import AssetBundle, WEATHER_BACKGROUND_URLS
 
 
 def style_columns():
@@ -20,23 +21,34 @@ def style_columns():
     return st.markdown(f'<style>{custom_style_async_cols}</style>', unsafe_allow_html=True)
 
 
-def assign_weather_background(weather_condition: str):
+def static_serving_enabled() -> bool:
     """
-    Changes background based on weather
+    Whether files in static/ are served by Streamlit (server.enableStaticServing).
     """
+    return bool(st.get_option("server.enableStaticServing"))
 
-    if weather_condition == 'rain':
-        url = "https://images.unsplash.com/photo-1620385019253-b051a26048ce?ixlib=rb-4.0.3&ixid" \
-              "=MnwxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8&auto=format&fit=crop&w=687&q=80"
-    elif weather_condition == 'sun':
-        url = "https://images.unsplash.com/photo-1559628376-f3fe5f782a2e?ixlib=rb-4.0.3&ixid" \
-              "=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D&auto=format&fit=crop&w=862&q=80"
-    elif weather_condition == 'covered':
-        url = "https://images.unsplash.com/photo-1500740516770-92bd004b996e?ixlib=rb-4.0.3&ixid" \
-              "=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D&auto=format&fit=crop&w=1472&q=80"
-    elif weather_condition == 'snow':
-        url = "https://images.unsplash.com/photo-1511131341194-24e2eeeebb09?ixlib=rb-4.0.3&ixid" \
-              "=MnwxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8&auto=format&fit=crop&w=1470&q=80"
+
+def assign_weather_background(weather_condition: str, asset_bundle: AssetBundle):
+    """
+    Changes background based on weather.
+
+    The background is served locally in the variant fitting the screen width
+    once it is downloaded, the remote image is only used until then.
+    """
+    variants = asset_bundle.background_variants(weather_condition) if static_serving_enabled() else []
+
+    if variants:
+        url = variants[-1].url
+        # Smaller screens get smaller variants, later rules win
+        media_rules = "".join(f"""
+    @media (max-width: {variant.width}px) {{
+    [data-testid="stAppViewContainer"] {{
+    background-image: url({variant.url});
+    }}
+    }}""" for variant in reversed(variants[:-1]))
+    else:
+        url = WEATHER_BACKGROUND_URLS[weather_condition]
+        media_rules = ""
 
     page_bg_img = f"""
     <style>
@@ -55,8 +67,27 @@ def assign_weather_background(weather_condition: str):
     }}
     [data-testid="stToolbar"] {{
     right: 2rem;
-    }}
+    }}{media_rules}
     </style>
     """
 
-    return st.markdown(page_bg_img, unsafe_allow_html=True)
\ No newline at end of file
+    return st.markdown(page_bg_img, unsafe_allow_html=True)
+
+
+def show_image(asset_bundle: AssetBundle, name: str, caption: str, width: int = 960):
+    """
+    Shows a pre-resized image of the asset bundle. With static serving the browser
+    picks the variant fitting the screen, otherwise the variant of width is sent.
+    """
+    if not static_serving_enabled():
+        return st.image(asset_bundle.image(name, width).path, caption=caption)
+
+    image_html = f"""
+    <figure style="margin: 0;">
+    <img src="{asset_bundle.image(name, width).url}" srcset="{asset_bundle.srcset(name)}"
+    sizes="(max-width: 768px) 100vw, 704px" alt="{caption}" loading="lazy" style="width: 100%;">
+    <figcaption style="text-align: center; font-size: 14px; opacity: 0.6;">{caption}</figcaption>
+    </figure>
+    """
+
+    return st.markdown(image_html, unsafe_allow_html=True)
@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import random
+import cProfile
+import asyncio
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Export of the metrics, a .prom file is written in Prometheus text format
+# (e.g. for the node exporter textfile collector), any other file gets JSON lines appended
+METRICS_FILE = os.environ.get("CO2_METRICS_FILE", "")
+METRICS_EXPORT_INTERVAL = float(os.environ.get("CO2_METRICS_EXPORT_INTERVAL", "15"))
+
+# Sampled cProfile captures of slow reruns, disabled with a sample rate of 0
+PROFILE_SAMPLE_RATE = float(os.environ.get("CO2_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_MIN_SECONDS = float(os.environ.get("CO2_PROFILE_MIN_SECONDS", "2"))
+PROFILE_DIR = os.environ.get("CO2_PROFILE_DIR", "profiles")
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _metric_key(name: str, labels: Dict[str, Any]) -> MetricKey:
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], **extra: str) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    escaped = (f'{key}="{value}"'.replace("\n", "\\n") for key, value in items)
+    return "{" + ",".join(escaped) + "}"
+
+
+class MetricsRegistry:
+    """
+    Thread-safe in-process registry of counters, gauges and timers.
+
+    Timers keep count, sum and max of the observed durations, which is enough
+    for rates and averages in Prometheus while staying cheap to record.
+    """
+
+    def __init__(self):
+        self._counters: Dict[MetricKey, float] = {}
+        self._gauges: Dict[MetricKey, float] = {}
+        self._timers: Dict[MetricKey, list] = {}
+        self._lock = threading.Lock()
+        self._last_export = 0.0
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[_metric_key(name, labels)] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            timer = self._timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def get_gauge(self, name: str, **labels) -> Optional[float]:
+        with self._lock:
+            return self._gauges.get(_metric_key(name, labels))
+
+    def to_prometheus(self) -> str:
+        """
+        Returns all metrics in Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f"{name}_total{_format_labels(labels)} {value}")
+            for (name, labels), value in sorted(self._gauges.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), (count, total, maximum) in sorted(self._timers.items()):
+                lines.append(f"{name}_seconds_count{_format_labels(labels)} {count}")
+                lines.append(f"{name}_seconds_sum{_format_labels(labels)} {total}")
+                lines.append(f"{name}_seconds_max{_format_labels(labels)} {maximum}")
+
+        return "\n".join(lines) + "\n"
+
+    def to_json_lines(self) -> str:
+        """
+        Returns all metrics as JSON lines, one line per metric.
+        """
+        timestamp = time.time()
+        records = []
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                records.append({'type': 'counter', 'name': name, 'labels': dict(labels), 'value': value})
+            for (name, labels), value in self._gauges.items():
+                records.append({'type': 'gauge', 'name': name, 'labels': dict(labels), 'value': value})
+            for (name, labels), (count, total, maximum) in self._timers.items():
+                records.append({'type': 'timer', 'name': name, 'labels': dict(labels),
+                                'count': count, 'sum': total, 'max': maximum})
+
+        return "".join(json.dumps({'timestamp': timestamp, **record}) + "\n" for record in records)
+
+    def export(self, path: str = METRICS_FILE, force: bool = False):
+        """
+        Writes the metrics to path at most every METRICS_EXPORT_INTERVAL seconds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if not path or (not force and now - self._last_export < METRICS_EXPORT_INTERVAL):
+                return
+            self._last_export = now
+
+        if path.endswith(".prom"):
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(self.to_prometheus())
+            os.replace(tmp_path, path)
+        else:
+            with open(path, 'a') as f:
+                f.write(self.to_json_lines())
+
+
+metrics = MetricsRegistry()
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """
+    Records the duration of the enclosed block as stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe("stage_duration", time.perf_counter() - start, stage=stage)
+
+
+def timed_stage(stage: str):
+    """
+    Decorator recording the duration of every call of a (async) function as stage.
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage_timer(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def instrument_cache(name: str, cache_decorator: Callable[[Callable], Any]):
+    """
+    Wraps a Streamlit cache decorator (st.cache_data / st.cache_resource) to count
+    calls and misses and to record when the cached value was last computed.
+
+    Hits are calls - misses, the staleness is now - cache_last_computed_timestamp.
+    """
+    def decorator(func):
+        @wraps(func)
+        def compute(*args, **kwargs):
+            metrics.increment("cache_misses", cache=name)
+            with stage_timer(name):
+                value = func(*args, **kwargs)
+            metrics.set_gauge("cache_last_computed_timestamp", time.time(), cache=name)
+            return value
+
+        cached_func = cache_decorator(compute)
+
+        @wraps(func)
+        def call(*args, **kwargs):
+            metrics.increment("cache_calls", cache=name)
+            return cached_func(*args, **kwargs)
+
+        call.clear = cached_func.clear
+        return call
+
+    return decorator
+
+
+class RerunProfiler:
+    """
+    Times a whole rerun of the app and captures a cProfile of a sample of the reruns.
+    Profiles of reruns slower than PROFILE_MIN_SECONDS are written to PROFILE_DIR.
+
+    Reruns ended early (st.stop(), st.experimental_rerun()) are finished with aborted=True.
+    A rerun ended by an exception is never finished, so it is counted as aborted by the
+    next profiler started on its thread (or any profiler once its thread ended), which
+    also disables its leftover cProfile.
+    """
+
+    _unfinished: Dict[threading.Thread, 'RerunProfiler'] = {}
+    _unfinished_lock = threading.Lock()
+
+    def __init__(self, sample_rate: float = PROFILE_SAMPLE_RATE):
+        self.thread = threading.current_thread()
+        self._abandon_unfinished()
+
+        self.start = time.perf_counter()
+        self.profile = None
+
+        if sample_rate > 0 and random.random() < sample_rate:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+        with self._unfinished_lock:
+            self._unfinished[self.thread] = self
+
+    def finish(self, aborted: bool = False):
+        if not self._pop_unfinished():
+            return
+
+        duration = time.perf_counter() - self.start
+        if aborted:
+            metrics.increment("reruns_aborted")
+            metrics.observe("stage_duration", duration, stage="rerun_aborted")
+        else:
+            metrics.increment("reruns")
+            metrics.observe("stage_duration", duration, stage="rerun")
+
+        if self.profile is not None:
+            self.profile.disable()
+            if duration >= PROFILE_MIN_SECONDS:
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                self.profile.dump_stats(os.path.join(PROFILE_DIR, f"rerun_{int(time.time() * 1000)}.prof"))
+                metrics.increment("profiles_captured")
+            self.profile = None
+
+        metrics.export()
+
+    def _pop_unfinished(self) -> bool:
+        with self._unfinished_lock:
+            if self._unfinished.get(self.thread) is not self:
+                return False
+            del self._unfinished[self.thread]
+            return True
+
+    def _abandon_unfinished(self):
+        with self._unfinished_lock:
+            abandoned = [profiler for thread, profiler in self._unfinished.items()
+                         if thread is self.thread or not thread.is_alive()]
+
+        for profiler in abandoned:
+            if not profiler._pop_unfinished():
+                continue
+
+            # The end of the rerun is unknown, so only the abort is counted
+            metrics.increment("reruns_aborted")
+            # A cProfile can only be disabled on the thread it profiles
+            if profiler.profile is not None and profiler.thread is self.thread:
+                profiler.profile.disable()
+            profiler.profile = None
@@ -0,0 +1,169 @@
+import logging
+import select
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+from utils.metrics_functions import metrics
+
+logger = logging.getLogger(__name__)
+
+# Channel the change triggers notify on, the payload is the name of the changed table
+CHANGE_CHANNEL = 'table_changes'
+
+# Tables the app and the API are notified about
+WATCHED_TABLES = ('product_data', 'current_weather', 'sun_hours', 'current_hydro_data')
+
+CHANGE_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION notify_table_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify(TG_ARGV[0], TG_ARGV[1]);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def install_change_trigger(conn, table: str, notify_as: Optional[str] = None, channel: str = CHANGE_CHANNEL):
+    """
+    Creates a statement trigger that notifies channel with notify_as (default: table)
+    after every insert, update, delete or truncate of table.
+
+    Views can not have statement triggers, for a view like current_weather the trigger
+    is installed on the table behind it with notify_as='current_weather'.
+    Notifications are sent on commit, the same payload is sent once per transaction.
+    """
+    notify_as = notify_as or table
+    for identifier in (table, notify_as, channel):
+        if not identifier.replace('.', '_').isidentifier():
+            raise ValueError(f"Invalid table or channel name: {identifier}")
+
+    trigger = f"{notify_as.replace('.', '_')}_change_notify"
+    cursor = conn.cursor()
+    cursor.execute(CHANGE_FUNCTION_SQL)
+    cursor.execute(f"DROP TRIGGER IF EXISTS {trigger} ON {table};")
+    cursor.execute(f"CREATE TRIGGER {trigger} AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table} "
+                   f"FOR EACH STATEMENT EXECUTE PROCEDURE notify_table_change('{channel}', '{notify_as}');")
+    cursor.close()
+    conn.commit()
+
+
+class TableChangeListener:
+    """
+    Listens to the change notifications of the database in a daemon thread and calls
+    the handler of the changed table.
+
+    connect_func has to return a psycopg2 connection, it is used for LISTEN only and
+    not taken from a pool. Notifications arriving together are handled once per table.
+    Notifications sent while the connection is down are lost, so after every
+    (re)connect on_connect is called to refresh everything the handlers would.
+    connected tells whether changes are currently pushed.
+    """
+
+    def __init__(self, connect_func: Callable[[], Any], handlers: Dict[str, Callable[[], None]],
+                 on_connect: Optional[Callable[[], None]] = None, channel: str = CHANGE_CHANNEL,
+                 poll_timeout: float = 5, reconnect_delay: float = 10):
+        if not channel.isidentifier():
+            raise ValueError(f"Invalid channel name: {channel}")
+
+        self.connect_func = connect_func
+        self.handlers = handlers
+        self.on_connect = on_connect
+        self.channel = channel
+        self.poll_timeout = poll_timeout
+        self.reconnect_delay = reconnect_delay
+
+        self.connected = False
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = self.connect_func()
+                conn.autocommit = True
+                cursor = conn.cursor()
+                cursor.execute(f"LISTEN {self.channel};")
+                cursor.close()
+
+                self.connected = True
+                metrics.increment("change_listener_connects")
+                self._call(self.on_connect, 'reconnect')
+
+                while not self._stopped.is_set():
+                    if not select.select([conn], [], [], self.poll_timeout)[0]:
+                        continue
+
+                    conn.poll()
+                    tables = {notification.payload for notification in conn.notifies}
+                    conn.notifies.clear()
+
+                    for table in sorted(tables):
+                        metrics.increment("table_change_notifications", table=table)
+                        self._call(self.handlers.get(table), table)
+            except Exception:
+                logger.warning("Change listener disconnected", exc_info=True)
+            finally:
+                self.connected = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+            self._stopped.wait(self.reconnect_delay)
+
+    @staticmethod
+    def _call(handler: Optional[Callable[[], None]], name: str):
+        if handler is None:
+            return
+        try:
+            handler()
+        except Exception:
+            logger.warning("Handling change of %s failed", name, exc_info=True)
+
+
+if __name__ == "__main__":
+    # Installs the triggers and prints the notifications, to check the setup against a local database:
+    #     python -m utils.notify_functions --install product_data current_weather=weather_data
+    # and change a row of a watched table in another session.
+    import argparse
+    import psycopg2
+    import toml
+
+    parser = argparse.ArgumentParser(description="Installs the change triggers and prints the notifications")
+    parser.add_argument('--secrets', default=".streamlit/secrets.toml")
+    parser.add_argument('--install', nargs='*', default=[], metavar='NAME[=TABLE]',
+                        help="Tables to install the trigger on, NAME=TABLE notifies NAME for changes of TABLE")
+    args = parser.parse_args()
+
+    postgres_secrets = toml.load(args.secrets)['postgres']
+
+    names = set(WATCHED_TABLES)
+    if args.install:
+        install_conn = psycopg2.connect(**postgres_secrets)
+        for spec in args.install:
+            name, _, table = spec.partition('=')
+            install_change_trigger(install_conn, table or name, notify_as=name)
+            names.add(name)
+            print(f"Installed change trigger for {name} on {table or name}")
+        install_conn.close()
+
+    listener = TableChangeListener(lambda: psycopg2.connect(**postgres_secrets),
+                                   {table: (lambda table=table: print(f"{table} changed"))
+                                    for table in names},
+                                   on_connect=lambda: print(f"Listening on {CHANGE_CHANNEL}"))
+    listener.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        listener.stop()
@@ -0,0 +1,258 @@
+import numpy as np
+import pandas as pd
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+from utils.metrics_functions import stage_timer
+from utils.plot_functions import create_color_list, create_color_legend, build_product_data_fig, \
+    build_product_density_fig, choose_render_mode, build_selection_patch, rgba_with_alpha, PatchedFigure, \
+    UNSELECTED_ALPHA
+
+
+class Pipeline:
+    """
+    Engine of named stages with declared inputs, memoized on those inputs.
+
+    Inputs are either sources passed to run() or other stages. A stage is only
+    recomputed if the key of one of its inputs changed since its last computation.
+    Source keys are passed to run() (e.g. a data version for a DataFrame) or default
+    to the source value itself if it is hashable. Stage keys are versions increased
+    on every recomputation, so unchanged stages do not trigger their dependents.
+    """
+
+    def __init__(self):
+        self._stages: Dict[str, Tuple[Callable, Tuple[str, ...]]] = {}
+        self._memo: Dict[str, Tuple[tuple, Any, int]] = {}
+        self.computed: List[str] = []
+
+    def add_stage(self, name: str, func: Callable, inputs: Iterable[str] = ()):
+        self._stages[name] = (func, tuple(inputs))
+        self._memo.pop(name, None)
+
+    def stage(self, name: str, inputs: Iterable[str] = ()):
+        """
+        Decorator registering a function as stage.
+        """
+        def decorator(func):
+            self.add_stage(name, func, inputs)
+            return func
+
+        return decorator
+
+    def run(self, targets: Iterable[str], sources: Dict[str, Any],
+            keys: Optional[Dict[str, Hashable]] = None) -> Dict[str, Any]:
+        """
+        Computes the target stages and the stale stages they depend on.
+        The names of the recomputed stages are stored in computed.
+        """
+        keys = keys or {}
+        results: Dict[str, Any] = {}
+        result_keys: Dict[str, Hashable] = {}
+        resolving = set()
+        self.computed = []
+
+        def resolve(name: str):
+            if name in results:
+                return
+
+            if name in sources:
+                results[name] = sources[name]
+                result_keys[name] = ('source', keys[name] if name in keys else _default_key(name, sources[name]))
+                return
+
+            if name not in self._stages:
+                raise ValueError(f"Unknown stage or missing source: {name}")
+            if name in resolving:
+                raise ValueError(f"Cyclic dependency at stage: {name}")
+
+            resolving.add(name)
+            func, inputs = self._stages[name]
+            for input_name in inputs:
+                resolve(input_name)
+            resolving.discard(name)
+
+            input_keys = tuple(result_keys[input_name] for input_name in inputs)
+            memo = self._memo.get(name)
+
+            if memo is None or memo[0] != input_keys:
+                with stage_timer(name):
+                    value = func(*(results[input_name] for input_name in inputs))
+                memo = (input_keys, value, memo[2] + 1 if memo is not None else 0)
+                self._memo[name] = memo
+                self.computed.append(name)
+
+            results[name] = memo[1]
+            result_keys[name] = (name, memo[2])
+
+        for target in targets:
+            resolve(target)
+
+        return {target: results[target] for target in targets}
+
+
+def _default_key(name: str, value: Any) -> Hashable:
+    if isinstance(value, (set, list)):
+        return frozenset(value) if isinstance(value, set) else tuple(value)
+    try:
+        hash(value)
+    except TypeError:
+        raise ValueError(f"Source {name} is not hashable, pass a key for it")
+    return value
+
+
+# --- Product data stages ---
+# The stages work on the shared read-only catalog, sessions only keep
+# positions of products in the catalog and masks instead of copies of the frame.
+
+def filter_positions(df: pd.DataFrame, categories: Optional[Tuple[str, ...]],
+                     subcategories: Optional[Tuple[str, ...]]) -> np.ndarray:
+    """
+    Positions of the products in the given categories and subcategories, None means no filter.
+    """
+    mask = np.ones(len(df), dtype=bool)
+    if categories is not None:
+        mask &= df['category'].isin(categories).to_numpy()
+    if subcategories is not None:
+        mask &= df['detailed_category'].isin(subcategories).to_numpy()
+
+    return np.flatnonzero(mask)
+
+
+def calc_value_ranges(df: pd.DataFrame, positions: np.ndarray) -> Dict[str, Tuple[float, float]]:
+    """
+    Emission and weight range of the products at positions, used for zooming.
+    """
+    ranges = {}
+    for column in ('emission', 'weight_gram'):
+        values = df[column].to_numpy()[positions]
+        ranges[column] = (float(values.min()), float(values.max())) if len(values) else (0.0, 0.0)
+
+    return ranges
+
+
+def zoom_positions(df: pd.DataFrame, positions: np.ndarray,
+                   zoom: Optional[Tuple[Tuple[float, float], Tuple[float, float]]]) -> np.ndarray:
+    """
+    Positions of the products within the (emission range, weight range) of zoom, all positions if zoom is None.
+    """
+    if zoom is None:
+        return positions
+
+    (min_emission, max_emission), (min_weight, max_weight) = zoom
+    emissions = df['emission'].to_numpy()[positions]
+    weights = df['weight_gram'].to_numpy()[positions]
+    zoom_mask = (emissions >= min_emission) & (emissions <= max_emission) & \
+        (weights >= min_weight) & (weights <= max_weight)
+
+    return positions if zoom_mask.all() else positions[zoom_mask]
+
+
+def query_selected_points(df: pd.DataFrame, positions: np.ndarray, selection: frozenset) -> Optional[np.ndarray]:
+    """
+    Indices within positions (sorted, e.g. from filter_positions) of the products selected
+    in the chart, the selection holds product IDs (index of df). None if there is no selection,
+    then all products count as selected. Only looks up the selected products, not all products.
+    """
+    if not selection:
+        return None
+
+    selected_positions = df.index.get_indexer(list(selection))
+    selected_positions = np.sort(selected_positions[selected_positions >= 0])
+
+    points = np.searchsorted(positions, selected_positions)
+    found = points < len(positions)
+    points, selected_positions = points[found], selected_positions[found]
+
+    return points[positions[points] == selected_positions]
+
+
+def build_colors(df: pd.DataFrame, positions: np.ndarray, color_level: str):
+    """
+    Colors of the products at positions as if all were selected, the legend colors
+    and the index of the first product of every category in the legend.
+    """
+    categories = df[color_level].take(positions).to_numpy()
+    color_list, category_color_list = create_color_list(
+        pd.DataFrame({color_level: categories, 'selected': np.ones(len(positions), dtype=bool)}), color_level)
+
+    codes, _ = pd.factorize(categories)
+    _, first_rows = np.unique(codes, return_index=True)
+
+    return color_list, category_color_list, np.sort(first_rows)
+
+
+def build_legend(colors: Tuple, selected_points: Optional[np.ndarray], filter_level: str) -> str:
+    """
+    Color legend with the color of the first product of every category, dimmed if it is not selected.
+    """
+    _, category_color_list, first_rows = colors
+    if selected_points is not None:
+        first_selected = np.isin(first_rows, selected_points)
+        category_color_list = [(category, color if selected else rgba_with_alpha(color, UNSELECTED_ALPHA))
+                               for (category, color), selected in zip(category_color_list, first_selected)]
+
+    return create_color_legend(category_color_list, level=filter_level)
+
+
+def build_base_fig(df: pd.DataFrame, positions: np.ndarray, colors: Tuple, filter_level: str, render_mode: str):
+    """
+    Figure of the products at positions colored as if all were selected, serialized to JSON
+    unless it is a density figure. It does not depend on the selection, so it is only
+    built once per filter, zoom and color level.
+    """
+    # The products are only copied while the figure is built
+    view_df = df.take(positions)
+    if render_mode == 'density':
+        return build_product_density_fig(view_df)
+
+    return build_product_data_fig(view_df, colors[0], level=filter_level, mode=render_mode).to_json()
+
+
+def apply_selection(base_fig, selected_points: Optional[np.ndarray]):
+    """
+    Product figure with the selection applied as a patch of the serialized base figure.
+    Density figures have no single products and are returned as they are.
+    """
+    if not isinstance(base_fig, str):
+        return base_fig
+
+    return PatchedFigure(base_fig, build_selection_patch(selected_points))
+
+
+def select_ids(df: pd.DataFrame, positions: np.ndarray, selected_points: Optional[np.ndarray]) -> pd.Index:
+    """
+    IDs of the selected products at positions, all of them if there is no selection.
+    """
+    if selected_points is None:
+        return df.index[positions]
+
+    return df.index[positions[selected_points]]
+
+
+def build_product_pipeline() -> Pipeline:
+    """
+    Creates the pipeline from the catalog to the product chart and picker.
+
+    Sources:
+        catalog: shared product DataFrame (pass a key, e.g. the data version)
+        categories, subcategories: tuples of the selected categories, None for no filter
+        zoom: (emission range, weight range) or None
+        selection: product IDs selected in the chart
+        color_level: column the colors are based on
+        filter_level: 'Category' or 'Subcategory'
+    """
+    pipeline = Pipeline()
+
+    pipeline.add_stage('filter_positions', filter_positions, ['catalog', 'categories', 'subcategories'])
+    pipeline.add_stage('render_mode', lambda positions: choose_render_mode(len(positions)), ['filter_positions'])
+    pipeline.add_stage('value_ranges', calc_value_ranges, ['catalog', 'filter_positions'])
+    pipeline.add_stage('view_positions', zoom_positions, ['catalog', 'filter_positions', 'zoom'])
+    pipeline.add_stage('view_render_mode', lambda positions: choose_render_mode(len(positions)),
+                       ['view_positions'])
+    pipeline.add_stage('selected_points', query_selected_points, ['catalog', 'view_positions', 'selection'])
+    pipeline.add_stage('colors', build_colors, ['catalog', 'view_positions', 'color_level'])
+    pipeline.add_stage('legend_html', build_legend, ['colors', 'selected_points', 'filter_level'])
+    pipeline.add_stage('base_fig', build_base_fig,
+                       ['catalog', 'view_positions', 'colors', 'filter_level', 'view_render_mode'])
+    pipeline.add_stage('product_fig', apply_selection, ['base_fig', 'selected_points'])
+    pipeline.add_stage('picker_ids', select_ids, ['catalog', 'view_positions', 'selected_points'])
+
+    return pipeline
@@ -1,71 +1,112 @@
+import json
 import colorsys
+import numpy as np
 import pandas as pd
+from functools import lru_cache
 import plotly.graph_objects as go
-import plotly.express as px
-from typing import List, Tuple
+from typing import List, Optional, Tuple
+from utils.metrics_functions import timed_stage
 
 
-def create_color_list(df: pd.DataFrame, category_level: str = 'category'):
+# Alpha of the colors of products selected in the chart and of the other products
+SELECTED_ALPHA = 0.8
+UNSELECTED_ALPHA = 0.2
+
+
+@timed_stage("create_color_list")
+def create_color_list(df: pd.DataFrame, category_level: str = 'category') -> Tuple[np.ndarray, List[Tuple[str, str]]]:
     """
     Creates RGBA values for every unique category-level in pd.DataFrame.
     Every category has two RGBA values where alpha corresponds to
-    selected=True --> alpha=0.8 and selected=False --> alpha=0.2
+    selected=True --> alpha=SELECTED_ALPHA and selected=False --> alpha=UNSELECTED_ALPHA
+
+    The RGBA strings are built once per category and looked up per row
+    through the categorical codes.
+
+    Returns:
+        Array of RGBA values per row and list of (category, RGBA) per unique category
+        for the color legend.
     """
-    num_categories = df[category_level].nunique()
-    color_map = []
+    codes, unique_categories = pd.factorize(df[category_level])
+    num_categories = len(unique_categories)
+
+    # Column 0: not selected, column 1: selected
+    color_table = np.empty((num_categories, 2), dtype=object)
 
     for i in range(num_categories):
         hue = i / num_categories
-        rgb = tuple(round(i * 255) for i in colorsys.hsv_to_rgb(hue, 0.7, 0.9))
-        color_map.append(rgb)
+        color = tuple(round(c * 255) for c in colorsys.hsv_to_rgb(hue, 0.7, 0.9))
+        color_table[i, 0] = f"rgba({color[0]}, {color[1]}, {color[2]}, {UNSELECTED_ALPHA})"
+        color_table[i, 1] = f"rgba({color[0]}, {color[1]}, {color[2]}, {SELECTED_ALPHA})"
 
-    unique_categories = df[category_level].unique()
-    category_color_map = {}
+    selected = df['selected'].to_numpy(dtype=bool).astype(np.intp)
+    color_list = color_table[codes, selected]
 
-    for i, category in enumerate(unique_categories):
-        category_color_map[category] = color_map[i % len(color_map)]
+    # Legend shows the color of the first product of every category
+    _, first_rows = np.unique(codes, return_index=True)
+    category_color_list = [(unique_categories[code], color_table[code, selected[row]])
+                           for code, row in zip(codes[first_rows], first_rows)]
 
-    color_list = []
-    category_color_list = []
+    return color_list, category_color_list
 
-    for category, selected in df[[category_level, 'selected']].values:
-        if selected:
-            opacity = 0.8
-        else:
-            opacity = 0.2
-        color = category_color_map[category]
-        rgba = f"rgba({color[0]}, {color[1]}, {color[2]}, {opacity})"
-        color_list.append(rgba)
-        category_color_list.append((category, rgba))
 
-    return color_list, category_color_list
+# Render modes of the product data figure by number of products
+SCATTERGL_MIN_POINTS = 5_000
+DENSITY_MIN_POINTS = 200_000
 
 
-def build_product_data_fig(df: pd.DataFrame, color_list: List[str], level: str = 'Category') -> go.Figure:
+def choose_render_mode(num_points: int) -> str:
     """
-    Creates go.Scatter figure of product data.
+    Chooses how to render the product data figure:
+    'svg' for small, 'webgl' for medium and 'density' for very large catalogs.
     """
+    if num_points >= DENSITY_MIN_POINTS:
+        return 'density'
+    if num_points >= SCATTERGL_MIN_POINTS:
+        return 'webgl'
+    return 'svg'
+
+
+@timed_stage("build_product_data_fig")
+def build_product_data_fig(df: pd.DataFrame, color_list: List[str], level: str = 'Category',
+                           mode: Optional[str] = None) -> go.Figure:
+    """
+    Creates go.Scatter figure of product data, or go.Scattergl for mode='webgl'.
+    If mode is None it is chosen based on the number of products.
+    The product ID (index of df) is carried as last element of customdata.
+    """
+    if mode is None:
+        mode = choose_render_mode(len(df))
+
+    scatter = go.Scattergl if mode == 'webgl' else go.Scatter
+
+    customdata = np.empty((len(df), 5), dtype=object)
+    customdata[:, 0] = df['name'].to_numpy()
+    customdata[:, 1] = df['price'].to_numpy()
+    customdata[:, 2] = df['category'].to_numpy()
+    customdata[:, 3] = df['detailed_category'].to_numpy()
+    customdata[:, 4] = df.index.to_numpy()
 
     fig = go.Figure()
 
-    fig.add_trace(go.Scatter(mode='markers',
-                             x=df['emission'],
-                             y=df['weight_gram'],
-                             marker=dict(
-                                 color=color_list,
-                                 size=df['price'] / 35,
-                                 sizemode='diameter',
-                                 sizemin=7
-                             ),
-                             hovertemplate='<b>%{customdata[0]}</b>'
-                                           '<br>Category: %{customdata[2]}'
-                                           '<br>Sub-category: %{customdata[3]}'
-                                           '<br>Price: CHF %{customdata[1]:,.2f}'
-                                           '<br>Weight: %{y:,} gram'
-                                           '<br>Emission: %{x} Kg/CO₂'
-                                           '<extra></extra>',
-                             customdata=list(zip(df['name'], df['price'], df['category'], df['detailed_category']))
-                             ))
+    fig.add_trace(scatter(mode='markers',
+                          x=df['emission'],
+                          y=df['weight_gram'],
+                          marker=dict(
+                              color=color_list,
+                              size=df['price'] / 35,
+                              sizemode='diameter',
+                              sizemin=7
+                          ),
+                          hovertemplate='<b>%{customdata[0]}</b>'
+                                        '<br>Category: %{customdata[2]}'
+                                        '<br>Sub-category: %{customdata[3]}'
+                                        '<br>Price: CHF %{customdata[1]:,.2f}'
+                                        '<br>Weight: %{y:,} gram'
+                                        '<br>Emission: %{x} Kg/CO₂'
+                                        '<extra></extra>',
+                          customdata=customdata
+                          ))
 
     title = f'💨⚖️ Emission vs Weight of products <br> ' \
             f'({level} separated by color and price displayed as size of circle)'
@@ -80,76 +121,166 @@ def build_product_data_fig(df: pd.DataFrame, color_list: List[str], level: str =
     return fig
 
 
-def create_color_legend(color_cat_map_list, level: str = 'Category'):
+def rgba_with_alpha(color: str, alpha: float) -> str:
+    """
+    Replaces the alpha of an RGBA string of create_color_list.
+    """
+    return f"{color[:color.rindex(',')]}, {alpha})"
+
+
+def build_selection_patch(selected_points: Optional[np.ndarray]) -> Optional[dict]:
+    """
+    Creates the changes of the product data trace that show the products at selected_points
+    (point indices in the trace) as selected and dim the others to UNSELECTED_ALPHA,
+    given the trace is colored as if all products were selected. None if all products are selected.
+    """
+    if selected_points is None:
+        return None
+
+    return {'selectedpoints': selected_points.tolist(),
+            'selected': {'marker': {'opacity': 1}},
+            'unselected': {'marker': {'opacity': UNSELECTED_ALPHA / SELECTED_ALPHA}}}
+
+
+class PatchedFigure:
+    """
+    Serialized figure whose first trace is patched with trace_patch when serialized.
+
+    Stands in for a go.Figure where only to_json() is used (e.g. plotly_events), so a
+    patch like the chart selection is applied to the cached JSON of the base figure
+    instead of building and serializing the figure again.
+    """
+
+    _TRACE_PREFIX = '{"data":[{'
+
+    def __init__(self, base_json: str, trace_patch: Optional[dict] = None):
+        self.base_json = base_json
+        self.trace_patch = trace_patch
+
+    def to_json(self) -> str:
+        if not self.trace_patch:
+            return self.base_json
+
+        # The patched keys are not part of the base trace, so they are inserted in front of it
+        if self.base_json.startswith(self._TRACE_PREFIX):
+            prefix_length = len(self._TRACE_PREFIX)
+            return f"{self._TRACE_PREFIX}{json.dumps(self.trace_patch)[1:-1]},{self.base_json[prefix_length:]}"
+
+        fig = json.loads(self.base_json)
+        fig['data'][0].update(self.trace_patch)
+        return json.dumps(fig)
+
+
+@timed_stage("build_product_density_fig")
+def build_product_density_fig(df: pd.DataFrame, bins: int = 100) -> go.Figure:
+    """
+    Creates go.Heatmap figure of the number of products per emission and weight bin.
+    The binning is done server side, so the figure size only depends on bins.
+    """
+    counts, emission_edges, weight_edges = np.histogram2d(df['emission'].to_numpy(dtype=float),
+                                                          df['weight_gram'].to_numpy(dtype=float),
+                                                          bins=bins)
+
+    # Empty bins are not drawn
+    counts = np.where(counts > 0, counts, np.nan)
+
+    fig = go.Figure()
+
+    fig.add_trace(go.Heatmap(x=(emission_edges[:-1] + emission_edges[1:]) / 2,
+                             y=(weight_edges[:-1] + weight_edges[1:]) / 2,
+                             z=counts.T,
+                             colorscale='Viridis',
+                             colorbar=dict(title='Products'),
+                             hovertemplate='Emission: %{x:,.2f} Kg/CO₂'
+                                           '<br>Weight: %{y:,.0f} gram'
+                                           '<br>Products: %{z:,}'
+                                           '<extra></extra>'))
+
+    title = f'💨⚖️ Emission vs Weight of products <br> ' \
+            '(number of products per bin, zoom into a region to see single products)'
+
+    fig.update_layout(
+        title=title,
+        xaxis_title="Emission in Kg/CO₂",
+        yaxis_title="Weight (gram)",
+        template='plotly_dark',
+        title_x=0.1)
+
+    return fig
+
+
+@timed_stage("create_color_legend")
+def create_color_legend(color_cat_map_list: List[Tuple[str, str]], level: str = 'Category') -> str:
     """
     Creates color legend for color category-level map
     """
+    return _build_color_legend(tuple(color_cat_map_list), level)
+
+
+@lru_cache(maxsize=128)
+def _build_color_legend(color_cat_map: Tuple[Tuple[str, str], ...], level: str) -> str:
+    """
+    Builds the legend HTML, cached per set of categories and colors.
+    """
     unique_categories = set()
-    legend_html = f"<h5>{level} Color Legend</h5>"
+    legend_html = [f"<h5>{level} Color Legend</h5>"]
 
     color_counter = 0
-    for category, color in color_cat_map_list:
+    for category, color in color_cat_map:
         if category not in unique_categories:
             if color_counter % 4 == 0:
-                legend_html += "<div style='display: flex;'>"
-            legend_html += "<div style='flex: 1;'>"
-            legend_html += f"<div style='display: flex; align-items: center; margin-bottom: 10px;'>"
-            legend_html += f"<span style='background-color: {color}; width: 20px; height: 20px; margin-right: 5px;'></span>"
-            legend_html += f"<span>{category}</span>"
-            legend_html += "</div>"
-            legend_html += "</div>"
+                legend_html.append("<div style='display: flex;'>")
+            legend_html.append("<div style='flex: 1;'>"
+                               "<div style='display: flex; align-items: center; margin-bottom: 10px;'>"
+                               f"<span style='background-color: {color}; width: 20px; height: 20px; "
+                               f"margin-right: 5px;'></span>"
+                               f"<span>{category}</span>"
+                               "</div>"
+                               "</div>")
             if color_counter % 4 == 3:
-                legend_html += "</div>"
+                legend_html.append("</div>")
             unique_categories.add(category)
             color_counter += 1
 
     # Check if the loop ended with an open <div> tag
     if color_counter % 4 != 0:
-        legend_html += "</div>"
+        legend_html.append("</div>")
 
-    return legend_html
+    return "".join(legend_html)
 
 
+@timed_stage("build_product_comparison_fig")
 def build_product_comparison_fig(selected_product_series: pd.Series, category_df: pd.DataFrame,
                                  category_level: str = 'category'):
     """
-    Create px.bar figure of selected product compared to other products in category_level.
-    """
+    Create go.Bar figure of selected product compared to other products in category_level.
 
-    category = category_df[category_level].iloc[0]
+    category_df holds the products to compare with, sorted by emission, e.g. the window
+    of nearest products by emission rank. The selected product is matched by its
+    product ID (index) and category_df is not modified.
+    """
+    category = selected_product_series[category_level]
     title = f'💨🎨 Emission Comparison of your product within category {category}'
 
-    # Create category dataframe
-    selected_product_df = pd.DataFrame(selected_product_series).transpose()
-    selected_product_df['selected'] = "Your Product"
-    category_df['selected'] = "Other Product"
-
-    selected_category_df = pd.concat([selected_product_df, category_df])
-
-    # Drop selected product duplicate out of category_df
-    selected_category_df.drop_duplicates(subset=['name', 'price', category_level,
-                                                 'emission', 'compensation_price',
-                                                 'weight_gram'], inplace=True)
+    if selected_product_series.name not in category_df.index:
+        category_df = pd.concat([category_df, selected_product_series.to_frame().transpose()])
+        category_df = category_df.sort_values(by='emission')
 
-    # Sort values and create unique product name for separate plotting
-    selected_category_df.sort_values(by='emission', ascending=True, inplace=True)
-    selected_category_df['product_name'] = selected_category_df.apply(lambda row: f"{row['name']}-{row['selected']}"
-                                                                                  f"-{row['price']}-{row['emission']}"
-                                                                                  f"-{row['compensation_price']}-"
-                                                                                  f"{row['weight_gram']}", axis=1)
+    # Product IDs are unique, so products with the same name are plotted separately
+    product_ids = category_df.index.astype(str).tolist()
+    is_selected = category_df.index == selected_product_series.name
 
+    emission_comparison_fig = go.Figure()
 
-    sorted_product_names = selected_category_df['product_name'].unique().tolist()
-
-    emission_comparison_fig = px.bar(selected_category_df,
-                                     x='product_name',
-                                     y='emission',
-                                     color='selected',
-                                     color_discrete_sequence=['darkseagreen', 'coral'],
-                                     custom_data=['price', 'category', 'detailed_category'],
-                                     title=title,
-                                     category_orders={'product_name': sorted_product_names}
-                                     )
+    for name, color, mask in (("Other Product", 'darkseagreen', ~is_selected),
+                              ("Your Product", 'coral', is_selected)):
+        bars = category_df[mask]
+        emission_comparison_fig.add_trace(go.Bar(x=np.array(product_ids)[mask],
+                                                 y=bars['emission'],
+                                                 name=name,
+                                                 legendgroup=name,
+                                                 marker_color=color,
+                                                 customdata=bars[['price', 'category', 'detailed_category']].to_numpy()))
 
     emission_comparison_fig.update_traces(hovertemplate='<br>Category: %{customdata[1]}'
                                                         '<br>Sub-category: %{customdata[2]}'
@@ -158,11 +289,15 @@ def build_product_comparison_fig(selected_product_series: pd.Series, category_df
                                                         '<extra></extra>')
 
     emission_comparison_fig.update_layout(
+        title=title,
+        legend_title_text='selected',
         xaxis_title='',
         xaxis=dict(
+            categoryorder='array',
+            categoryarray=product_ids,
             tickmode='array',
-            tickvals=selected_category_df['product_name'].to_list(),
-            ticktext=selected_category_df['name'].to_list()
+            tickvals=product_ids,
+            ticktext=category_df['name'].to_list()
         ),
         yaxis_title='Emission in Kg/CO₂',
         hovermode='x unified',
@@ -170,3 +305,36 @@ def build_product_comparison_fig(selected_product_series: pd.Series, category_df
 
     return emission_comparison_fig
 
+
+@timed_stage("build_basket_share_fig")
+def build_basket_share_fig(basket_df: pd.DataFrame, max_items: int = 15) -> go.Figure:
+    """
+    Create horizontal go.Bar figure of the items contributing most to the basket emission.
+    basket_df holds one row per item with the columns name, quantity, emission (of the item) and share.
+    """
+    top_items = basket_df.nlargest(max_items, 'share').iloc[::-1]
+
+    fig = go.Figure()
+
+    fig.add_trace(go.Bar(x=top_items['share'] * 100,
+                         y=top_items.index.astype(str),
+                         orientation='h',
+                         marker_color='coral',
+                         customdata=top_items[['name', 'quantity', 'emission']].to_numpy(),
+                         hovertemplate='<b>%{customdata[0]}</b>'
+                                       '<br>Quantity: %{customdata[1]}'
+                                       '<br>Emission: %{customdata[2]:,.2f} Kg/CO₂'
+                                       '<br>Share: %{x:.1f} %'
+                                       '<extra></extra>'))
+
+    fig.update_layout(
+        title='🧺💨 Products contributing most to the emission of your basket',
+        xaxis_title='Share of basket emission in %',
+        yaxis=dict(
+            tickmode='array',
+            tickvals=top_items.index.astype(str).tolist(),
+            ticktext=top_items['name'].to_list()
+        ),
+        title_x=0.1)
+
+    return fig
@@ -0,0 +1,122 @@
+import re
+import bisect
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits text into lowercase words.
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def create_product_label(name: str, category: str, price: float) -> str:
+    """
+    Creates the label of a product shown in the product picker.
+    """
+    return f"{name} - {category} - CHF {price:.2f}"
+
+
+class ProductSearchIndex:
+    """
+    In-memory search index over product name, category and price.
+
+    Every word of a product is stored in an inverted index (word -> product positions).
+    Query words are matched as substrings of the indexed words, found through a
+    trigram index over the vocabulary, or as prefixes for words shorter than three
+    characters. All query words have to match. Results are returned in alphabetical
+    order of the product labels and resolve directly to product IDs (index of df).
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.product_ids = df.index.to_numpy()
+        self.labels = [create_product_label(name, category, price)
+                       for name, category, price in zip(df['name'], df['category'], df['price'])]
+
+        # Position of every product in the alphabetical order of the labels
+        label_order = np.argsort(np.array(self.labels, dtype=object), kind='stable')
+        self.label_rank = np.empty(len(label_order), dtype=np.int64)
+        self.label_rank[label_order] = np.arange(len(label_order))
+        self.label_order = label_order
+
+        postings: Dict[str, List[int]] = defaultdict(list)
+        for position, label in enumerate(self.labels):
+            for word in set(tokenize(label)):
+                postings[word].append(position)
+
+        self.postings: Dict[str, np.ndarray] = {word: np.array(positions, dtype=np.int64)
+                                                for word, positions in postings.items()}
+        self.vocabulary = sorted(self.postings)
+
+        self.trigrams: Dict[str, Set[str]] = defaultdict(set)
+        for word in self.vocabulary:
+            for i in range(len(word) - 2):
+                self.trigrams[word[i:i + 3]].add(word)
+
+        self._id_index = pd.Index(self.product_ids)
+
+    def __len__(self) -> int:
+        return len(self.product_ids)
+
+    def label(self, product_id) -> str:
+        return self.labels[self._id_index.get_loc(product_id)]
+
+    def search(self, query: str, limit: int = 50, offset: int = 0,
+               allowed_ids: Optional[Sequence] = None) -> Tuple[np.ndarray, int]:
+        """
+        Returns the IDs of the matching products from offset to offset + limit
+        and the total number of matches. allowed_ids restricts the search to a subset
+        of the products (e.g. the products left after filtering).
+        """
+        positions = None
+        for query_word in tokenize(query):
+            word_positions = self._match_word(query_word)
+            positions = word_positions if positions is None else np.intersect1d(positions, word_positions,
+                                                                                assume_unique=True)
+
+        if allowed_ids is not None:
+            allowed = np.zeros(len(self), dtype=bool)
+            allowed_positions = self._id_index.get_indexer(allowed_ids)
+            allowed[allowed_positions[allowed_positions >= 0]] = True
+
+            if positions is None:
+                positions = np.flatnonzero(allowed)
+            else:
+                positions = positions[allowed[positions]]
+
+        if positions is None:
+            # No query and no restriction: all products in label order
+            return self.product_ids[self.label_order[offset:offset + limit]], len(self)
+
+        # Alphabetical order of the labels, only the requested page is fully sorted
+        ranks = self.label_rank[positions]
+        end = min(offset + limit, len(ranks))
+        if end < len(ranks):
+            ranks = ranks[np.argpartition(ranks, end - 1)[:end]]
+        page_ranks = np.sort(ranks)[offset:end]
+
+        return self.product_ids[self.label_order[page_ranks]], len(positions)
+
+    def _match_word(self, query_word: str) -> np.ndarray:
+        if len(query_word) < 3:
+            start = bisect.bisect_left(self.vocabulary, query_word)
+            end = bisect.bisect_left(self.vocabulary, query_word + "￿")
+            words = self.vocabulary[start:end]
+        else:
+            candidates = None
+            for i in range(len(query_word) - 2):
+                trigram_words = self.trigrams.get(query_word[i:i + 3], set())
+                candidates = trigram_words if candidates is None else candidates & trigram_words
+                if not candidates:
+                    break
+            words = [word for word in candidates if query_word in word]
+
+        if not words:
+            return np.empty(0, dtype=np.int64)
+
+        return np.unique(np.concatenate([self.postings[word] for word in words]))
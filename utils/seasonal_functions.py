@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+from typing import NamedTuple, Sequence
+from utils.calc_co2_offset_functions import ArrayLike, COMPENSATION_METHODS, calc_trees_offset_batch, \
+    calc_solar_energy_offset_batch, calc_hydro_offset_batch
+
+DAYS_PER_YEAR = 365
+
+# Days averaged around every day of the year to smooth the profiles
+SMOOTHING_DAYS = 15
+
+
+def build_seasonal_profile(dates: Sequence, values: ArrayLike, smoothing_days: int = SMOOTHING_DAYS) -> np.ndarray:
+    """
+    Averages a daily series over all years per day of the year.
+
+    Feb 29 counts as Mar 1. Days of the year without data are interpolated from their
+    neighbours and the profile is smoothed with a moving average of smoothing_days days,
+    both wrapping around the turn of the year.
+
+    Returns:
+        np.ndarray with one value per day of the year (index 0 = Jan 1).
+    """
+    dates = pd.to_datetime(pd.Series(dates)).reset_index(drop=True)
+    values = np.asarray(values, dtype=np.float64)
+
+    days = dates.dt.dayofyear.to_numpy() - 1 - (dates.dt.is_leap_year & (dates.dt.month > 2)).to_numpy()
+    valid = dates.notna().to_numpy() & ~np.isnan(values)
+
+    if not valid.any():
+        raise ValueError("No values to build a seasonal profile from")
+
+    days = days[valid].astype(np.intp)
+    sums = np.bincount(days, weights=values[valid], minlength=DAYS_PER_YEAR)
+    counts = np.bincount(days, minlength=DAYS_PER_YEAR)
+
+    known_days = np.flatnonzero(counts)
+    profile = np.interp(np.arange(DAYS_PER_YEAR), known_days, sums[known_days] / counts[known_days],
+                        period=DAYS_PER_YEAR)
+
+    half_window = smoothing_days // 2
+    if half_window > 0:
+        padded = np.concatenate([profile[-half_window:], profile, profile[:half_window]])
+        profile = np.convolve(padded, np.ones(2 * half_window + 1) / (2 * half_window + 1), mode='valid')
+
+    return profile
+
+
+class SeasonalOffsets(NamedTuple):
+    """
+    Daily CO2 offset per compensation method (rows) for one year starting at start_day
+    and its cumulative sum.
+    """
+    start_day: int
+    daily: np.ndarray
+    cumulative: np.ndarray
+
+
+def build_seasonal_offsets(sun_hours_profile: np.ndarray, flow_rate_profile: np.ndarray, start_day: int,
+                           num_trees: int = 1) -> SeasonalOffsets:
+    """
+    Calculates the daily offset of every compensation method for the year starting at
+    start_day (day of the year, 0 = Jan 1) from the seasonal profiles of sun hours and Aare flow.
+    """
+    year_days = (start_day + np.arange(DAYS_PER_YEAR)) % DAYS_PER_YEAR
+
+    daily = np.vstack([np.full(DAYS_PER_YEAR, calc_trees_offset_batch(num_trees)),
+                       calc_solar_energy_offset_batch(sun_hours_profile[year_days]),
+                       calc_hydro_offset_batch(flow_rate_profile[year_days])])
+
+    return SeasonalOffsets(start_day, daily, np.cumsum(daily, axis=1))
+
+
+def calc_compensation_days_seasonal(emission: ArrayLike, seasonal_offsets: SeasonalOffsets) -> pd.DataFrame:
+    """
+    Calculates the days needed per compensation method to offset every emission in CO2/KG
+    when the daily offset follows the seasonal profile from start_day on.
+
+    Whole years are skipped through the yearly total, the day the cumulative offset passes
+    the rest of the emission is found by binary search and interpolated within that day.
+    If emission is a pd.Series its index is kept.
+
+    Returns:
+        pd.DataFrame with one row per emission and one column per compensation method.
+        Methods without any offset over the year have np.inf days.
+    """
+    index = emission.index if isinstance(emission, pd.Series) else None
+    emissions = np.atleast_1d(np.asarray(emission, dtype=np.float64))
+    days = np.empty((len(emissions), len(COMPENSATION_METHODS)), dtype=np.float64)
+
+    for i, (daily, cumulative) in enumerate(zip(seasonal_offsets.daily, seasonal_offsets.cumulative)):
+        year_total = cumulative[-1]
+        if year_total <= 0:
+            days[:, i] = np.inf
+            continue
+
+        years, rest = np.divmod(emissions, year_total)
+        day = np.searchsorted(cumulative, rest, side='left')
+        previous = np.where(day > 0, cumulative[day - 1], 0.0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = np.where(rest > previous, (rest - previous) / daily[day], 0.0)
+
+        days[:, i] = years * DAYS_PER_YEAR + day + fraction
+
+    return pd.DataFrame(days, index=index, columns=COMPENSATION_METHODS)
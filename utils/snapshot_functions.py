@@ -0,0 +1,102 @@
+import os
+import time
+import logging
+import threading
+import pandas as pd
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_TABLES = ['product_data', 'current_weather', 'sun_hours', 'current_hydro_data',
+                   'sun_hours_history', 'hydro_history']
+
+
+class SnapshotStore:
+    """
+    Local columnar (Parquet) snapshots of the database tables.
+
+    Snapshots are kept in memory after the first read and written atomically to
+    directory, so the app can render from them right away on a cold start, refresh
+    them in the background and run without any database at all.
+    """
+
+    def __init__(self, directory: str = 'snapshots'):
+        self.directory = directory
+
+        self._frames: Dict[str, pd.DataFrame] = {}
+        self._refreshing: Dict[str, threading.Thread] = {}
+        self._queued: Dict[str, Callable[[], Optional[pd.DataFrame]]] = {}
+        self._lock = threading.Lock()
+
+    def path(self, table: str) -> str:
+        return os.path.join(self.directory, f"{table}.parquet")
+
+    def get(self, table: str) -> Optional[pd.DataFrame]:
+        """
+        Returns the snapshot of table or None if there is none.
+        """
+        with self._lock:
+            if table in self._frames:
+                return self._frames[table]
+
+        if not os.path.exists(self.path(table)):
+            return None
+
+        df = pd.read_parquet(self.path(table))
+        with self._lock:
+            self._frames.setdefault(table, df)
+            return self._frames[table]
+
+    def put(self, table: str, df: pd.DataFrame):
+        """
+        Replaces the snapshot of table in memory and on disk.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.path(table)}.{threading.get_ident()}.tmp"
+        df.to_parquet(tmp_path)
+        os.replace(tmp_path, self.path(table))
+
+        with self._lock:
+            self._frames[table] = df
+
+    def age(self, table: str) -> float:
+        """
+        Seconds since the snapshot of table was written, inf if there is none.
+        """
+        try:
+            return time.time() - os.path.getmtime(self.path(table))
+        except OSError:
+            return float('inf')
+
+    def refresh_async(self, table: str, loader: Callable[[], Optional[pd.DataFrame]], queue: bool = False):
+        """
+        Reloads table with loader in a background thread and stores the result.
+        A loader returning None keeps the current snapshot.
+        Does nothing if a refresh of table is already running, unless queue is set:
+        then the table is reloaded once more afterwards (e.g. because it changed meanwhile).
+        """
+        with self._lock:
+            running = self._refreshing.get(table)
+            if running is not None and running.is_alive():
+                if queue:
+                    self._queued[table] = loader
+                return
+            thread = threading.Thread(target=self._refresh, args=(table, loader), daemon=True)
+            self._refreshing[table] = thread
+
+        thread.start()
+
+    def _refresh(self, table: str, loader: Callable[[], Optional[pd.DataFrame]]):
+        while loader is not None:
+            try:
+                df = loader()
+                if df is not None:
+                    self.put(table, df)
+            except Exception:
+                # Keep serving the old snapshot, the next refresh tries again
+                logger.warning("Refreshing snapshot %s failed", table, exc_info=True)
+
+            with self._lock:
+                loader = self._queued.pop(table, None)
+                if loader is None:
+                    del self._refreshing[table]
@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+from typing import Any, Dict, NamedTuple, Sequence, Tuple
+
+
+def build_category_emission_index(df: pd.DataFrame,
+                                  category_level: str = 'category') -> Dict[Any, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Sorts the products of every category-level by emission once.
+
+    Returns:
+        Dict of category -> (emissions sorted ascending, product IDs in the same order).
+        The product IDs correspond to the index of df.
+    """
+    codes, categories = pd.factorize(df[category_level])
+    emissions = df['emission'].to_numpy(dtype=np.float64)
+    product_ids = df.index.to_numpy()
+
+    # Sort by category first and by emission within category
+    order = np.lexsort((emissions, codes))
+    sorted_codes = codes[order]
+    boundaries = np.flatnonzero(np.diff(sorted_codes)) + 1
+
+    category_index = {}
+    for group in np.split(order, boundaries):
+        if len(group) == 0 or codes[group[0]] < 0:
+            continue
+        category_index[categories[codes[group[0]]]] = (emissions[group], product_ids[group])
+
+    return category_index
+
+
+def get_emission_window(sorted_emissions: np.ndarray, sorted_product_ids: np.ndarray,
+                        product_id: Any, emission: float, k: int = 30) -> np.ndarray:
+    """
+    Returns the IDs of the k products nearest by emission rank to the given product
+    (itself included), sorted by emission.
+
+    The rank is found by binary search, so the cost is O(log n + k).
+    """
+    left = np.searchsorted(sorted_emissions, emission, side='left')
+    right = np.searchsorted(sorted_emissions, emission, side='right')
+
+    # Products with equal emission share a rank, find the product itself among them
+    matches = np.flatnonzero(sorted_product_ids[left:right] == product_id)
+    rank = left + matches[0] if len(matches) else left
+
+    start = min(max(rank - k // 2, 0), max(len(sorted_emissions) - k, 0))
+
+    return sorted_product_ids[start:start + k]
+
+
+class EmissionStats(NamedTuple):
+    """
+    Emission statistics of a group of products.
+    emissions is sorted ascending, product_ids holds the IDs in the same order.
+    """
+    count: int
+    mean: float
+    min: float
+    max: float
+    emissions: np.ndarray
+    product_ids: np.ndarray
+
+
+def calc_emission_stats(sorted_emissions: np.ndarray, sorted_product_ids: np.ndarray) -> EmissionStats:
+    """
+    Creates EmissionStats out of emission-sorted arrays.
+    """
+    if len(sorted_emissions) == 0:
+        return EmissionStats(0, np.nan, np.nan, np.nan, sorted_emissions, sorted_product_ids)
+
+    return EmissionStats(count=len(sorted_emissions),
+                         mean=float(sorted_emissions.mean()),
+                         min=float(sorted_emissions[0]),
+                         max=float(sorted_emissions[-1]),
+                         emissions=sorted_emissions,
+                         product_ids=sorted_product_ids)
+
+
+def build_stats_index(df: pd.DataFrame, levels: Tuple[str, ...] = ('category', 'detailed_category')) -> Dict[str, Any]:
+    """
+    Computes the emission statistics of all products and of every group in levels once.
+
+    Returns:
+        Dict with key 'all' -> EmissionStats of all products and
+        one key per level -> Dict of category -> EmissionStats.
+    """
+    order = np.argsort(df['emission'].to_numpy(dtype=np.float64), kind='stable')
+    stats_index: Dict[str, Any] = {
+        'all': calc_emission_stats(df['emission'].to_numpy(dtype=np.float64)[order], df.index.to_numpy()[order])
+    }
+
+    for level in levels:
+        stats_index[level] = {category: calc_emission_stats(emissions, product_ids)
+                              for category, (emissions, product_ids)
+                              in build_category_emission_index(df, level).items()}
+
+    return stats_index
+
+
+def calc_percentile_rank(stats: EmissionStats, emission: float) -> float:
+    """
+    Percentage of products in stats with a lower emission, found by binary search in O(log n).
+    """
+    return float(np.searchsorted(stats.emissions, emission, side='left') / stats.count * 100)
+
+
+def calc_percentile_ranks(category_stats: Dict[Any, EmissionStats], categories: Sequence,
+                          emissions: Sequence) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized version of calc_percentile_rank for many products at once, every product is
+    ranked within its category. Products of categories missing in category_stats get NaN.
+
+    Returns:
+        Percentile ranks and mean emissions of the categories, one per product.
+    """
+    codes, unique_categories = pd.factorize(pd.Series(categories))
+    emissions = np.asarray(emissions, dtype=np.float64)
+
+    ranks = np.full(len(emissions), np.nan)
+    means = np.full(len(emissions), np.nan)
+
+    order = np.argsort(codes, kind='stable')
+    boundaries = np.flatnonzero(np.diff(codes[order])) + 1
+
+    for group in np.split(order, boundaries):
+        if len(group) == 0 or codes[group[0]] < 0:
+            continue
+        stats = category_stats.get(unique_categories[codes[group[0]]])
+        if stats is None or stats.count == 0:
+            continue
+        ranks[group] = np.searchsorted(stats.emissions, emissions[group], side='left') / stats.count * 100
+        means[group] = stats.mean
+
+    return ranks, means